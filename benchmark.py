@@ -0,0 +1,184 @@
+"""Benchmarks of the prep pipeline's hot paths against their original versions.
+
+Each benchmark times the current implementation in bot against a copy of the
+code it replaced, on the same input, and fails (exit code 1) unless both give
+identical output.
+
+    python benchmark.py tokenize --data tweet_data/data.context
+    python benchmark.py cleanse --num_tweets 200000
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import random
+import re
+import sys
+import time
+
+import bot
+
+#######################################################################
+# the original implementations, as they were before the batched paths #
+#######################################################################
+
+_WORD_SPLIT = re.compile(b"([.,!?\"':;)(])")
+_DIGIT_RE = re.compile(br"\d")
+
+
+def reference_basic_tokenizer(sentence):
+    """Very basic tokenizer: split the sentence into a list of tokens."""
+    words = []
+    for space_separated_fragment in sentence.strip().split():
+        words.extend(re.split(_WORD_SPLIT, space_separated_fragment))
+    return [w for w in words if w]
+
+
+def reference_sentence_to_token_ids(sentence, vocabulary):
+    """ The original sentence_to_token_ids, with digit normalization """
+    words = reference_basic_tokenizer(sentence)
+    return [vocabulary.get(re.sub(_DIGIT_RE, b"0", w), bot.UNK_ID) for w in words]
+
+
+def reference_cleanse_text(text):
+    """ The original per-word cleansing of cleanse_tweets, for one text """
+    # regex pattern from http://stackoverflow.com/questions/6883049/regex-to-find-urls-in-string-in-python
+    regURL = re.compile('http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+    tList = text.split()
+    for i in range(len(tList)):
+        tList[i] = re.sub(u"(\u2018|\u2019|\u201c|\u201d)", "'", tList[i])
+        tList[i] = re.sub(u"(\xe9)", "e", tList[i])
+        tList[i] = re.sub(u"(\u2014)", "-", tList[i])
+        tList[i] = re.sub(r'[^\x00-\x7F]+', '', tList[i])
+        match = regURL.match(tList[i])
+        if match:
+            tList[i] = ""
+    return ' '.join(tList)
+
+
+# pieces of random tweets for the cleansing benchmark: plain words and
+# punctuation, everything the cleansing maps or strips, urls at the start and
+# inside words, and odd whitespace
+_TWEET_PIECES = [
+    u"Breaking", u"news", u"the", u"President", u"said", u"2016", u"#tbt",
+    u"@nytimes", u"RT", u":", u",", u".", u"!", u"(via", u"@Reuters)",
+    u"\u2018quoted\u2019", u"\u201cdouble\u201d", u"caf\xe9", u"\xe9lite",
+    u"a\u2014b", u"\u2014", u"na\xefve", u"\u4e2d\u6587", u"\U0001f600",
+    u"\u2026", u"\xa0", u"https://t.co/AbC123", u"http://nyti.ms/2hXbZ",
+    u"(http://wsj.com/x?a=1&b=%20)", u"see:https://t.co/q", u"http://",
+    u"\u201chttps://t.co/z\u201d", u"\xe9http://t.co/e", u"\thttp://t.co/t",
+    u"  ", u"\n", u"\t", u"\u2003", u"URL", u"https://t.co/\xe9\u2014x",
+]
+
+
+def random_tweets(num_tweets, seed=0):
+    """ Returns num_tweets random tweet texts built from _TWEET_PIECES """
+    rng = random.Random(seed)
+    return [u" ".join(rng.choice(_TWEET_PIECES)
+                      for _ in range(rng.randint(0, 30)))
+            for _ in range(num_tweets)]
+
+
+def _timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def _report(name, reference_seconds, seconds, identical):
+    print("%s: original %.3fs, current %.3fs, speedup %.1fx, output %s"
+          % (name, reference_seconds, seconds,
+             reference_seconds / max(seconds, 1e-9),
+             "identical" if identical else "DIFFERENT"))
+    return identical
+
+
+def benchmark_tokenize(sentences, vocabulary):
+    """ Times the original per-sentence tokenization against
+        bot.batch_sentence_to_token_ids and compares their token ids
+
+        Inputs:
+            list of bytes -- sentences
+            dictionary -- vocabulary -- token (bytes) to id
+        Returns:
+            bool -- whether the outputs are identical
+    """
+    reference, reference_seconds = _timed(
+        lambda: [reference_sentence_to_token_ids(s, vocabulary) for s in sentences])
+    (token_ids, offsets), seconds = _timed(
+        bot.batch_sentence_to_token_ids, sentences, vocabulary)
+    token_ids, offsets = token_ids.tolist(), offsets.tolist()
+    current = [token_ids[offsets[i]:offsets[i + 1]] for i in range(len(sentences))]
+    return _report("tokenize %d sentences" % len(sentences),
+                   reference_seconds, seconds, current == reference)
+
+
+def benchmark_cleanse(texts, num_workers=None):
+    """ Times the original per-word cleansing against bot.cleanse_texts
+        (whole-text passes, chunks across a process pool) and compares their
+        output
+
+        Inputs:
+            list of strings -- texts -- tweet texts
+            int -- num_workers -- processes for cleanse_texts
+        Returns:
+            bool -- whether the outputs are identical
+    """
+    reference, reference_seconds = _timed(
+        lambda: [reference_cleanse_text(t) for t in texts])
+    single, single_seconds = _timed(bot.cleanse_texts, texts, 1)
+    pooled, seconds = _timed(bot.cleanse_texts, texts, num_workers)
+    identical = _report("cleanse %d tweets, one process" % len(texts),
+                        reference_seconds, single_seconds, single == reference)
+    return _report("cleanse %d tweets, process pool" % len(texts),
+                   reference_seconds, seconds, pooled == reference) and identical
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="benchmark")
+    tokenize = subparsers.add_parser("tokenize", help="batched tokenizer")
+    tokenize.add_argument("--data", default="tweet_data/data.context",
+                          help="data file, one sentence per line")
+    tokenize.add_argument("--vocab", default="",
+                          help="vocabulary file (default: built from --data)")
+    tokenize.add_argument("--vocab_size", type=int, default=5000,
+                          help="size of the vocabulary built from --data; "
+                               "smaller than the data's, so UNK_ID is hit")
+    tokenize.add_argument("--repeat", type=int, default=1,
+                          help="tokenize the data this many times over")
+    cleanse = subparsers.add_parser("cleanse", help="tweet cleansing")
+    cleanse.add_argument("--num_tweets", type=int, default=100000,
+                         help="number of random tweets to cleanse")
+    cleanse.add_argument("--seed", type=int, default=0)
+    cleanse.add_argument("--num_workers", type=int, default=0,
+                         help="processes for cleanse_texts (0: cpu count)")
+    args = parser.parse_args()
+
+    if args.benchmark == "tokenize":
+        with open(args.data, "rb") as f:
+            sentences = f.readlines() * args.repeat
+        if args.vocab:
+            vocabulary, _ = bot.initialize_vocabulary(args.vocab)
+        else:
+            counts = {}
+            for s in sentences:
+                for w in reference_basic_tokenizer(s):
+                    w = re.sub(_DIGIT_RE, b"0", w)
+                    counts[w] = counts.get(w, 0) + 1
+            vocab_list = (bot._START_VOCAB +
+                          sorted(counts, key=counts.get, reverse=True))
+            vocabulary = dict((w, i) for i, w in
+                              enumerate(vocab_list[:args.vocab_size]))
+        identical = benchmark_tokenize(sentences, vocabulary)
+    elif args.benchmark == "cleanse":
+        identical = benchmark_cleanse(random_tweets(args.num_tweets, args.seed),
+                                      args.num_workers or None)
+    else:
+        parser.error("choose a benchmark")
+    sys.exit(0 if identical else 1)
+
+
+if __name__ == "__main__":
+    main()
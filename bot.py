@@ -3,18 +3,32 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import calendar
 import gzip
+import heapq
+import json
+import mmap
+import multiprocessing
 import os
 import re
+import struct
 import tarfile
+import zlib
+from array import array
+from collections import Counter
 
+import numpy as np
 from six.moves import urllib
 
 from tensorflow.python.platform import gfile
 
 from secrets import *
 import tweepy
-import threading
+import time
+import bpe
+import fetch_scheduler
+import stage_cache
+import tweet_store
 import re  # regex library
 
 # Special vocabulary symbols - we always put them at the start.
@@ -32,6 +46,13 @@ UNK_ID = 3
 # Regular expressions used to tokenize.
 _WORD_SPLIT = re.compile(b"([.,!?\"':;)(])")
 _DIGIT_RE = re.compile(br"\d")
+# One-pass equivalent of splitting on whitespace and then on _WORD_SPLIT.
+_TOKEN_RE = re.compile(br"[.,!?\"':;)(]|[^\s.,!?\"':;)(]+")
+# bytes.translate table equivalent to re.sub(_DIGIT_RE, b"0", ...).
+_DIGIT_TABLE = bytes.maketrans(b"0123456789", b"0" * 10)
+
+# buffer size of the data files written by data_to_file
+_WRITE_BUFFER = 1 << 20
 
 # set vocab size
 vocab_size = 500000  # TODO update if necessary
@@ -48,10 +69,7 @@ api = tweepy.API(auth)
 
 def basic_tokenizer(sentence):
     """Very basic tokenizer: split the sentence into a list of tokens."""
-    words = []
-    for space_separated_fragment in sentence.strip().split():
-        words.extend(re.split(_WORD_SPLIT, space_separated_fragment))
-    return [w for w in words if w]
+    return _TOKEN_RE.findall(sentence)
 
 
 def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
@@ -97,6 +115,118 @@ def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
                     vocab_file.write(w + b"\n")
 
 
+def _count_shard(args):
+    """Count the tokens of every line that starts inside [start, end) of a file.
+
+    A line belongs to the shard that holds its first byte, so shards can be
+    cut at arbitrary byte offsets and still cover every line exactly once.
+    Counter preserves first-occurrence order, which keeps the merged counts in
+    the same order a single sequential pass would produce.
+    """
+    data_path, start, end, tokenizer, normalize_digits = args
+    counts = Counter()
+    with gfile.GFile(data_path, mode="rb") as f:
+        if start > 0:
+            # skip the tail of a line owned by the previous shard
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if tokenizer:
+                tokens = tokenizer(line)
+                if normalize_digits:
+                    tokens = [w.translate(_DIGIT_TABLE) for w in tokens]
+            else:
+                # digits never split a basic_tokenizer token, so normalizing
+                # the whole line once is the same as normalizing every token
+                if normalize_digits:
+                    line = line.translate(_DIGIT_TABLE)
+                tokens = basic_tokenizer(line)
+            counts.update(tokens)
+    return counts
+
+
+def count_tokens(data_path, tokenizer=None, normalize_digits=True,
+                 num_workers=None):
+    """Count token frequencies of a data file in parallel byte-range shards.
+
+    Args:
+    data_path: data file in one-sentence-per-line format.
+    tokenizer: a function to use to tokenize each data sentence;
+      if None, basic_tokenizer will be used. Must be picklable (module level)
+      when num_workers > 1.
+    normalize_digits: Boolean; if true, all digits are replaced by 0s.
+    num_workers: number of counting processes; defaults to the cpu count.
+
+    Returns:
+    a Counter mapping token to count, in first-occurrence order of the file.
+    """
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    size = os.path.getsize(data_path)
+    num_workers = max(1, min(num_workers, size // (1 << 20) + 1))
+    bounds = [size * i // num_workers for i in range(num_workers + 1)]
+    shards = [(data_path, bounds[i], bounds[i + 1], tokenizer, normalize_digits)
+              for i in range(num_workers)]
+    if num_workers == 1:
+        partials = [_count_shard(shards[0])]
+    else:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            partials = pool.map(_count_shard, shards)
+        finally:
+            pool.close()
+            pool.join()
+    # merge in shard order so ties keep their order of first appearance
+    counts = partials[0]
+    for partial in partials[1:]:
+        counts.update(partial)
+    return counts
+
+
+def create_vocabulary_parallel(vocabulary_path, data_path, max_vocabulary_size,
+                               tokenizer=None, normalize_digits=True,
+                               num_workers=None, counts_path=None):
+    """Sharded, multi-process version of create_vocabulary.
+
+    Writes the same vocabulary file as create_vocabulary, byte for byte, but
+    counts the data file across a process pool and selects the most frequent
+    tokens with a heap instead of sorting the whole count table. The raw counts
+    are also saved (one "token count" pair per line) so that later stages can
+    reuse them without re-reading the data.
+
+    Args:
+    vocabulary_path: path where the vocabulary will be created.
+    data_path: data file that will be used to create vocabulary.
+    max_vocabulary_size: limit on the size of the created vocabulary.
+    tokenizer: a function to use to tokenize each data sentence;
+      if None, basic_tokenizer will be used.
+    normalize_digits: Boolean; if true, all digits are replaced by 0s.
+    num_workers: number of counting processes; defaults to the cpu count.
+    counts_path: where to save the token counts; defaults to
+      vocabulary_path + ".counts".
+    """
+    if gfile.Exists(vocabulary_path):
+        return
+    print("Creating vocabulary %s from data %s" % (vocabulary_path, data_path))
+    counts = count_tokens(data_path, tokenizer, normalize_digits, num_workers)
+    if len(counts) + len(_START_VOCAB) > max_vocabulary_size:
+        print("vocab too big")
+    keep = max(0, max_vocabulary_size - len(_START_VOCAB))
+    # nlargest is documented as sorted(..., reverse=True)[:n], ties included
+    vocab_list = _START_VOCAB + heapq.nlargest(keep, counts, key=counts.get)
+    vocab_list = vocab_list[:max_vocabulary_size]
+    with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
+        vocab_file.write(b"".join(w + b"\n" for w in vocab_list))
+    if counts_path is None:
+        counts_path = vocabulary_path + ".counts"
+    with gfile.GFile(counts_path, mode="wb") as counts_file:
+        counts_file.write(b"".join(w + b" " + str(c).encode("ascii") + b"\n"
+                                   for w, c in counts.items()))
+
+
 def initialize_vocabulary(vocabulary_path):
     """Initialize vocabulary from file.
 
@@ -127,6 +257,143 @@ def initialize_vocabulary(vocabulary_path):
         raise ValueError("Vocabulary file %s not found.", vocabulary_path)
 
 
+# Compiled vocabulary: a header, int64 string offsets (one more than there are
+# tokens), an int32 open-addressing hash table of token ids (-1 marks an empty
+# slot, crc32 hash, linear probing) and the token strings back to back.
+_COMPILED_MAGIC = b"TWVOCAB1"
+_COMPILED_HEADER = struct.Struct("<8sQQQ")
+_COMPILED_SUFFIX = ".idx"
+
+
+def compile_vocabulary(vocabulary_path, compiled_path=None):
+    """Writes the compiled (memory-mappable, hashed) form of a vocabulary file.
+
+    Token ids and the handling of repeated tokens (the last one wins) are the
+    same as in initialize_vocabulary.
+
+    Args:
+    vocabulary_path: path to the file containing the vocabulary.
+    compiled_path: where to write it; defaults to vocabulary_path + ".idx".
+    """
+    with gfile.GFile(vocabulary_path, mode="rb") as f:
+        rev_vocab = [line.strip() for line in f]
+    num_slots = 1
+    while num_slots < 2 * len(rev_vocab):
+        num_slots *= 2
+    mask = num_slots - 1
+    slots = array("i", [-1]) * num_slots
+    for token_id, token in enumerate(rev_vocab):
+        slot = zlib.crc32(token) & mask
+        while slots[slot] != -1 and rev_vocab[slots[slot]] != token:
+            slot = (slot + 1) & mask
+        slots[slot] = token_id
+    offsets = array("q", [0])
+    for token in rev_vocab:
+        offsets.append(offsets[-1] + len(token))
+    with gfile.GFile(compiled_path or vocabulary_path + _COMPILED_SUFFIX,
+                     mode="wb") as f:
+        f.write(_COMPILED_HEADER.pack(_COMPILED_MAGIC, len(rev_vocab),
+                                      num_slots, offsets[-1]))
+        f.write(offsets.tobytes())
+        f.write(slots.tobytes())
+        f.write(b"".join(rev_vocab))
+
+
+class CompiledVocabulary(object):
+    """Read-only vocabulary backed by a memory-mapped compiled vocabulary file.
+
+    Nothing is parsed at load time: get() hashes the token and probes the
+    mapped hash table, and rev_vocab indexes the mapped string table, so it
+    can stand in for the (vocab, rev_vocab) pair of initialize_vocabulary.
+    """
+
+    def __init__(self, compiled_path):
+        with open(compiled_path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size, num_slots, _ = _COMPILED_HEADER.unpack_from(self._map)
+        if magic != _COMPILED_MAGIC:
+            raise ValueError("%s is not a compiled vocabulary." % compiled_path)
+        view = memoryview(self._map)
+        start = _COMPILED_HEADER.size
+        self._offsets = view[start:start + 8 * (size + 1)].cast("q")
+        start += 8 * (size + 1)
+        self._slots = view[start:start + 4 * num_slots].cast("i")
+        self._strings = start + 4 * num_slots
+        self._mask = num_slots - 1
+        self._size = size
+        self.rev_vocab = _ReverseVocabulary(self)
+
+    def token(self, token_id):
+        """Returns the token (bytes) with id token_id."""
+        begin = self._strings + self._offsets[token_id]
+        return self._map[begin:self._strings + self._offsets[token_id + 1]]
+
+    def get(self, token, default=None):
+        """Returns the id of token, or default if it is not in the vocabulary."""
+        slot = zlib.crc32(token) & self._mask
+        token_id = self._slots[slot]
+        while token_id != -1:
+            if self.token(token_id) == token:
+                return token_id
+            slot = (slot + 1) & self._mask
+            token_id = self._slots[slot]
+        return default
+
+    def __getitem__(self, token):
+        token_id = self.get(token)
+        if token_id is None:
+            raise KeyError(token)
+        return token_id
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __len__(self):
+        # unique tokens, like the dict of initialize_vocabulary
+        return sum(1 for token_id in self._slots if token_id != -1)
+
+
+class _ReverseVocabulary(object):
+    """List-like id -> token view of a CompiledVocabulary."""
+
+    def __init__(self, vocabulary):
+        self._vocabulary = vocabulary
+
+    def __getitem__(self, token_id):
+        if token_id < 0:
+            token_id += len(self)
+        if not 0 <= token_id < len(self):
+            raise IndexError("token id %d out of range" % token_id)
+        return self._vocabulary.token(token_id)
+
+    def __len__(self):
+        return self._vocabulary._size
+
+
+def load_vocabulary(vocabulary_path):
+    """Like initialize_vocabulary, but memory-maps the compiled vocabulary
+    (compiling it first if it is missing or older than the vocabulary file).
+
+    Args:
+    vocabulary_path: path to the file containing the vocabulary.
+
+    Returns:
+    a pair: a CompiledVocabulary (token to id, with a dict-like get), and the
+    reversed vocabulary (an indexable id to token view).
+
+    Raises:
+    ValueError: if the provided vocabulary_path does not exist.
+    """
+    if not gfile.Exists(vocabulary_path):
+        raise ValueError("Vocabulary file %s not found." % vocabulary_path)
+    compiled_path = vocabulary_path + _COMPILED_SUFFIX
+    if (not os.path.exists(compiled_path) or
+            os.path.getmtime(compiled_path) < os.path.getmtime(vocabulary_path)):
+        compile_vocabulary(vocabulary_path, compiled_path)
+    vocab = CompiledVocabulary(compiled_path)
+    return vocab, vocab.rev_vocab
+
+
 def sentence_to_token_ids(sentence, vocabulary,
                           tokenizer=None, normalize_digits=True):
     """Convert a string to list of integers representing token-ids.
@@ -145,14 +412,48 @@ def sentence_to_token_ids(sentence, vocabulary,
     Returns:
     a list of integers, the token-ids for the sentence.
     """
-    if tokenizer:
-        words = tokenizer(sentence)
-    else:
-        words = basic_tokenizer(sentence)
-    if not normalize_digits:
-        return [vocabulary.get(w, UNK_ID) for w in words]
-    # Normalize digits by 0 before looking words up in the vocabulary.
-    return [vocabulary.get(re.sub(_DIGIT_RE, b"0", w), UNK_ID) for w in words]
+    token_ids, _ = batch_sentence_to_token_ids([sentence], vocabulary,
+                                               tokenizer, normalize_digits)
+    return token_ids.tolist()
+
+
+def batch_sentence_to_token_ids(sentences, vocabulary,
+                                tokenizer=None, normalize_digits=True):
+    """Convert many sentences to token-ids at once, packed into two arrays.
+
+    With the default tokenizer every sentence is digit-normalized with a single
+    bytes.translate and split with one precompiled regex pass; digits never
+    split a token, so this gives the same ids as normalizing token by token.
+
+    Args:
+    sentences: an iterable of sentences in bytes format.
+    vocabulary: a dictionary mapping tokens to integers.
+    tokenizer: a function to use to tokenize each sentence;
+      if None, basic_tokenizer will be used.
+    normalize_digits: Boolean; if true, all digits are replaced by 0s.
+
+    Returns:
+    a pair of numpy arrays: int32 token ids of all sentences concatenated, and
+    int64 offsets such that the ids of sentence i are
+    token_ids[offsets[i]:offsets[i + 1]].
+    """
+    get = vocabulary.get
+    findall = _TOKEN_RE.findall
+    token_ids = array("i")
+    offsets = array("q", [0])
+    for sentence in sentences:
+        if tokenizer:
+            words = tokenizer(sentence)
+            if normalize_digits:
+                words = [w.translate(_DIGIT_TABLE) for w in words]
+        else:
+            if normalize_digits:
+                sentence = sentence.translate(_DIGIT_TABLE)
+            words = findall(sentence)
+        token_ids.extend([get(w, UNK_ID) for w in words])
+        offsets.append(len(token_ids))
+    return (np.frombuffer(token_ids, dtype=np.int32),
+            np.frombuffer(offsets, dtype=np.int64))
 
 
 def data_to_token_ids(data_path, target_path, vocabulary_path,
@@ -185,6 +486,273 @@ def data_to_token_ids(data_path, target_path, vocabulary_path,
                                             normalize_digits)
                     tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
 
+# Binary token-id corpus: a flat int32 array of all token ids plus an int64
+# offsets array (one more entry than there are lines), saved as .npy files next
+# to the corpus path so they can be opened with np.load(..., mmap_mode="r").
+_TOKENS_SUFFIX = ".tokens.npy"
+_OFFSETS_SUFFIX = ".offsets.npy"
+
+
+def token_ids_paths(corpus_path):
+    """Returns the (tokens, offsets) .npy paths of a binary token-id corpus."""
+    return corpus_path + _TOKENS_SUFFIX, corpus_path + _OFFSETS_SUFFIX
+
+
+def save_token_ids(token_ids, offsets, corpus_path):
+    """Saves packed token ids (see batch_sentence_to_token_ids) as a binary
+    token-id corpus at corpus_path; see token_ids_paths."""
+    tokens_path, offsets_path = token_ids_paths(corpus_path)
+    np.save(tokens_path, np.asarray(token_ids, dtype=np.int32))
+    np.save(offsets_path, np.asarray(offsets, dtype=np.int64))
+
+
+def write_token_ids(token_id_lines, corpus_path):
+    """Saves an iterable of token-id lists as a binary token-id corpus.
+
+    Args:
+    token_id_lines: iterable of lists of integers, one list per line.
+    corpus_path: base path of the corpus; see token_ids_paths.
+    """
+    tokens = array("i")
+    offsets = array("q", [0])
+    for token_ids in token_id_lines:
+        tokens.extend(token_ids)
+        offsets.append(len(tokens))
+    save_token_ids(np.frombuffer(tokens, dtype=np.int32),
+                   np.frombuffer(offsets, dtype=np.int64), corpus_path)
+
+
+def data_to_token_ids_binary(data_path, corpus_path, vocabulary_path,
+                             tokenizer=None, normalize_digits=True):
+    """Like data_to_token_ids, but writes a binary token-id corpus.
+
+    Args:
+    data_path: path to the data file in one-sentence-per-line format.
+    corpus_path: base path of the binary corpus that will be created.
+    vocabulary_path: path to the vocabulary file.
+    tokenizer: a function to use to tokenize each sentence;
+      if None, basic_tokenizer will be used.
+    normalize_digits: Boolean; if true, all digits are replaced by 0s.
+    """
+    if gfile.Exists(token_ids_paths(corpus_path)[0]):
+        return
+    print("Tokenizing data in %s" % data_path)
+    vocab, _ = initialize_vocabulary(vocabulary_path)
+    with gfile.GFile(data_path, mode="rb") as data_file:
+        token_ids, offsets = batch_sentence_to_token_ids(
+            data_file, vocab, tokenizer, normalize_digits)
+    save_token_ids(token_ids, offsets, corpus_path)
+
+
+def text_ids_to_binary(ids_path, corpus_path=None):
+    """Converts a text token-id file (as written by data_to_token_ids) into a
+    binary token-id corpus.
+
+    Args:
+    ids_path: path to the space-separated token-id file.
+    corpus_path: base path of the binary corpus; defaults to ids_path.
+    """
+    print("Converting token ids in %s to binary" % ids_path)
+    with gfile.GFile(ids_path, mode="r") as ids_file:
+        write_token_ids(([int(x) for x in line.split()] for line in ids_file),
+                        corpus_path or ids_path)
+
+
+def load_token_ids(corpus_path):
+    """Opens a binary token-id corpus memory-mapped, read-only.
+
+    If only the old text format exists at corpus_path, it is converted first.
+
+    Returns:
+    a pair of arrays: int32 token ids and int64 line offsets; the ids of line i
+    are tokens[offsets[i]:offsets[i + 1]].
+    """
+    tokens_path, offsets_path = token_ids_paths(corpus_path)
+    if not gfile.Exists(tokens_path):
+        if not gfile.Exists(corpus_path):
+            raise ValueError("Token-id corpus %s not found." % corpus_path)
+        text_ids_to_binary(corpus_path)
+    return (np.load(tokens_path, mmap_mode="r"),
+            np.load(offsets_path, mmap_mode="r"))
+
+
+def read_counts(counts_path):
+    """Returns the token counts saved by create_vocabulary_parallel, as a
+    numpy int64 array sorted from most to least frequent."""
+    with gfile.GFile(counts_path, mode="rb") as f:
+        counts = [int(line.rsplit(b" ", 1)[1]) for line in f if line.strip()]
+    return np.sort(np.array(counts, dtype=np.int64))[::-1]
+
+
+def fitted_vocabulary_size(vocabulary_path, coverage=0.0, min_count=0,
+                           counts_path=None):
+    """Returns how many entries of a vocabulary (special tokens included) to
+    keep so that it still covers the data.
+
+    The vocabulary is sorted by frequency, so keeping its first entries keeps
+    the most frequent tokens; the cutoff is the smallest size that covers at
+    least the coverage fraction of all token occurrences in the data, and/or
+    drops tokens seen fewer than min_count times, whichever is smaller.
+
+    Args:
+    vocabulary_path: vocabulary made by create_vocabulary_parallel.
+    coverage: fraction of token occurrences to cover (0: no limit).
+    min_count: least count of a kept token (0: no limit).
+    counts_path: its token counts; defaults to vocabulary_path + ".counts".
+    """
+    counts = read_counts(counts_path or vocabulary_path + ".counts")
+    keep = len(counts)
+    if min_count:
+        keep = min(keep, int(np.count_nonzero(counts >= min_count)))
+    if coverage and len(counts):
+        covered = np.cumsum(counts) / float(counts.sum())
+        keep = min(keep, int(np.searchsorted(covered, coverage)) + 1)
+    with gfile.GFile(vocabulary_path, mode="rb") as f:
+        full_size = sum(1 for _ in f)
+    return min(len(_START_VOCAB) + keep, full_size)
+
+
+def truncate_vocabulary(vocabulary_path, size, truncated_path):
+    """Writes (and compiles) the first size entries of a vocabulary."""
+    with gfile.GFile(vocabulary_path, mode="rb") as f:
+        entries = [line for _, line in zip(range(size), f)]
+    with gfile.GFile(truncated_path, mode="wb") as f:
+        f.write(b"".join(entries))
+    compile_vocabulary(truncated_path)
+
+
+def remap_token_ids(corpus_path, size, remapped_path, chunk_tokens=1 << 24):
+    """Writes a copy of a binary token-id corpus for the vocabulary truncated
+    to size entries: every id past the cutoff becomes UNK_ID."""
+    tokens, offsets = load_token_ids(corpus_path)
+    remapped = np.empty(len(tokens), dtype=np.int32)
+    for begin in range(0, len(tokens), chunk_tokens):
+        chunk = tokens[begin:begin + chunk_tokens]
+        remapped[begin:begin + len(chunk)] = np.where(chunk < size, chunk, UNK_ID)
+    save_token_ids(remapped, offsets, remapped_path)
+
+
+def fit_vocabulary(vocabulary_path, corpus_paths, coverage=0.0, min_count=0):
+    """Truncates a vocabulary to fitted_vocabulary_size and remaps the token-id
+    corpora built with it to match. The results are named like the originals
+    with the new size in place of vocab_size (e.g. vocab12000.user), and are
+    rebuilt only when their inputs change (see stage_cache).
+
+    Returns:
+    a triple: the fitted size, the truncated vocabulary's path and the list
+    of remapped corpus paths (the originals if nothing was cut).
+    """
+    size = fitted_vocabulary_size(vocabulary_path, coverage, min_count)
+    old_name = "%d." % vocab_size
+    new_name = "%d." % size
+
+    def renamed(path):
+        directory, name = os.path.split(path)
+        if old_name not in name:
+            raise ValueError("Cannot name the fitted version of %s." % path)
+        return os.path.join(directory, name.replace(old_name, new_name, 1))
+
+    with gfile.GFile(vocabulary_path, mode="rb") as f:
+        if sum(1 for _ in f) <= size:
+            return size, vocabulary_path, list(corpus_paths)
+    cache = stage_cache.StageCache(os.path.join("tweet_data", "manifest.json"))
+    truncated_path = renamed(vocabulary_path)
+    key = stage_cache.hash_values(stage_cache.hash_file(vocabulary_path), size)
+    outputs = [truncated_path, truncated_path + _COMPILED_SUFFIX]
+    stage = "fit:" + truncated_path
+    if not cache.is_fresh(stage, key, outputs):
+        cache.invalidate(stage, outputs)
+        truncate_vocabulary(vocabulary_path, size, truncated_path)
+        cache.record(stage, key, outputs)
+    remapped_paths = []
+    for corpus_path in corpus_paths:
+        remapped_path = renamed(corpus_path)
+        key = stage_cache.hash_values(
+            size, *[stage_cache.hash_file(p) for p in token_ids_paths(corpus_path)])
+        outputs = list(token_ids_paths(remapped_path))
+        stage = "fit:" + remapped_path
+        if not cache.is_fresh(stage, key, outputs):
+            cache.invalidate(stage, outputs)
+            remap_token_ids(corpus_path, size, remapped_path)
+            cache.record(stage, key, outputs)
+        remapped_paths.append(remapped_path)
+    print("fitted %s to %d entries" % (vocabulary_path, size))
+    return size, truncated_path, remapped_paths
+
+
+# settings of the fitted vocabularies a model is built for, in its train dir
+VOCAB_SETTINGS = "vocab.json"
+
+
+def fit_vocabularies(context_vocab, user_vocab, context_paths, user_paths,
+                     coverage=0.0, min_count=0, num_samples=512, bpe_merges=0):
+    """Fits the context and user vocabularies to the data (see fit_vocabulary).
+
+    Returns:
+    the settings to build a model for them with: the vocabulary paths and
+    sizes, the number of softmax samples, the fitted corpus paths
+    (context_corpora and user_corpora) and the fitting parameters.
+    """
+    context_size, context_vocab, context_paths = fit_vocabulary(
+        context_vocab, context_paths, coverage, min_count)
+    user_size, user_vocab, user_paths = fit_vocabulary(
+        user_vocab, user_paths, coverage, min_count)
+    # Sampled softmax only pays off for output vocabularies well above the
+    # number of samples; below that the full softmax is cheap and exact.
+    num_samples = num_samples if user_size > 4 * num_samples else 0
+    return {"context_vocab": context_vocab, "user_vocab": user_vocab,
+            "en_vocab_size": context_size, "fr_vocab_size": user_size,
+            "num_samples": num_samples,
+            "context_corpora": context_paths, "user_corpora": user_paths,
+            "bpe_merges": bpe_merges,
+            "vocab_coverage": coverage,
+            "vocab_min_count": min_count}
+
+
+def save_vocab_settings(train_dir, settings):
+    """Writes the settings of fit_vocabularies to train_dir."""
+    if not os.path.exists(train_dir):
+        os.makedirs(train_dir)
+    with open(os.path.join(train_dir, VOCAB_SETTINGS), "w") as f:
+        json.dump(settings, f, indent=1, sort_keys=True)
+
+
+def load_vocab_settings(train_dir):
+    """Returns the settings saved in train_dir by save_vocab_settings, or None."""
+    path = os.path.join(train_dir, VOCAB_SETTINGS)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def bpe_words(sentence):
+    """Splits a sentence into the words BPE merges are learned on and applied
+    to: the basic_tokenizer tokens of the digit-normalized sentence."""
+    return basic_tokenizer(sentence.translate(_DIGIT_TABLE))
+
+
+def bpe_merges_path(num_merges):
+    """Returns the path of the num_merges BPE merges download_and_prepare
+    learns."""
+    return os.path.join("tweet_data", "bpe%d.merges" % num_merges)
+
+
+def learn_bpe(merges_path, data_paths, num_merges):
+    """Learns num_merges BPE merges from the words of data files (see bpe)."""
+    print("Learning %d BPE merges from %s" % (num_merges, " and ".join(data_paths)))
+    counts = Counter()
+    for data_path in data_paths:
+        counts.update(count_tokens(data_path))
+    bpe.save_merges(merges_path, bpe.learn_merges(counts, num_merges))
+
+
+def bpe_tokenizer(num_merges):
+    """Returns a tokenizer splitting sentences into the subwords of the
+    num_merges BPE merges download_and_prepare learned."""
+    return bpe.BPETokenizer(bpe.load_merges(bpe_merges_path(num_merges)),
+                            bpe_words)
+
 #####################################################
 
 
@@ -300,14 +868,79 @@ def get_n_neighbors(values, index, n): # TODO returning same tweets every time?
     return neighbors
 
 
+def tweet_epochs(tweets):
+    """ Returns the creation times of tweets as an int64 array of epoch seconds
+
+        Inputs:
+            list of status objs. -- tweets -- tweets with naive UTC created_at
+        Returns:
+            numpy array of int64 -- seconds since the epoch, one per tweet
+    """
+    if isinstance(tweets, tweet_store.TweetColumns):
+        return tweets.epochs
+    return np.array([calendar.timegm(t.created_at.utctimetuple()) for t in tweets],
+                    dtype=np.int64)
+
+
+def align_by_date(targetEpochs, sourceEpochs, n):
+    """ Finds, for every target time, a window of the n source tweets around
+        the last source tweet posted at or before it, all at once.
+
+        The window holds n/2 tweets at or before the target time and n/2
+        after it, shifted to stay inside the source near either end. The
+        source does not need to be sorted.
+
+        Inputs:
+            numpy array of int64 -- targetEpochs -- times to align, epoch secs
+            numpy array of int64 -- sourceEpochs -- times of the source tweets
+            int -- n -- (even) number of neighbors per target
+        Returns:
+            numpy array of int64 -- (len(targetEpochs), n) matrix of indices
+                into the source, oldest first; -1 where the source has fewer
+                than n tweets
+    """
+    targetEpochs = np.asarray(targetEpochs, dtype=np.int64)
+    windows = np.full((len(targetEpochs), n), -1, dtype=np.int64)
+    size = len(sourceEpochs)
+    width = min(n, size)
+    if width == 0:
+        return windows
+    order = np.argsort(sourceEpochs, kind="mergesort")
+    sortedEpochs = np.asarray(sourceEpochs, dtype=np.int64)[order]
+    # last source tweet at or before each target (-1 if there is none)
+    closest = np.searchsorted(sortedEpochs, targetEpochs, side="right") - 1
+    start = np.clip(closest - (n // 2 - 1), 0, size - width)
+    windows[:, :width] = order[start[:, None] + np.arange(width)]
+    return windows
+
+
+def align_sources(sourceTweets, n=4):
+    """ Aligns every user tweet against every context source (see
+        align_by_date)
+
+        Inputs:
+            list of lists of status objects (or TweetColumns) -- sourceTweets --
+                list of all tweets from user and contexts
+                [[all users], [all source 1],...]
+            int -- n -- (even) number of neighbors per source
+        Returns:
+            list of numpy arrays -- one (len(user tweets), n) index matrix
+                per context source
+    """
+    userEpochs = tweet_epochs(sourceTweets[0])
+    return [align_by_date(userEpochs, tweet_epochs(source), n)
+            for source in sourceTweets[1:]]
+
+
 def group_by_date(sourceTweets):
     """ Returns a dictionary grouping user tweets with associated context.
-        Context of a tweet is 5 closest tweets (by time) from each news source
-        (25 total tweets).
+        Context of a tweet is the 4 closest tweets (by time) from each news
+        source.
 
         Inputs:
-            list of lists of status objects -- sourceTweets -- list of all
-                tweets from user and contexts [[all users], [all source 1],...]
+            list of lists of status objects (or TweetColumns) -- sourceTweets --
+                list of all tweets from user and contexts
+                [[all users], [all source 1],...]
         Returns:
             dictionary (tweetid, list of status objs.) -- dictionary of contexts
                 for each user tweet for trainging (90% of data), keyed by unique ids
@@ -323,62 +956,138 @@ def group_by_date(sourceTweets):
     # get all context tweets
     contextTweets = sourceTweets[1:]
 
+    # 4 neighbors (2 at or before and 2 after if possible) from each source
+    windows = align_sources(sourceTweets, 4)
+
+    # gather the context of every user tweet into one object matrix
+    gathered, present = [], []
+    for source, window in zip(contextTweets, windows):
+        statuses = np.empty(len(source) + 1, dtype=object)
+        statuses[:-1] = list(source)
+        # -1 (missing neighbor) picks the trailing None
+        gathered.append(statuses[window])
+        present.append(window >= 0)
+    if gathered:
+        gathered = np.hstack(gathered)
+        present = np.hstack(present)
+        if present.all():
+            contexts = gathered.tolist()
+        else:
+            contexts = [row[mask].tolist() for row, mask in zip(gathered, present)]
+    else:
+        contexts = [[] for _ in userTweets]
+
     for i in range(len(userTweets)):
-        status = userTweets[i]
-        tweetId = status.id  # int
-        tweetDatetime = status.created_at  # datetime obj
-        context = []
-        # find five closest tweets form each context (by time)
-        for source in contextTweets:
-            # get context tweet closest (at or before) status
-            closest = binary_search_tweets_by_date(source, tweetDatetime, 0, len(source) - 1)
-            # get 4 neighbors (2 before and 2 after if possible, or closest)
-            neighbors = get_n_neighbors(source, closest, 4)
-            # build context
-            context.extend(neighbors)
+        context = contexts[i]
         # if in first 90%, add to context for training
         if (i/float(len(userTweets))) < 0.9:
             # add context with tweet to dict
-            contextByTweet[tweetId] = context
+            contextByTweet[userTweets[i].id] = context
         # otherwise add to validation set
         else:
-            contextByTweetValid[tweetId] = context
+            contextByTweetValid[userTweets[i].id] = context
 
     return contextByTweet, contextByTweetValid
 
 
-def cleanse_tweets(tweets):
+# str.translate table for cleanse_text: "bad" quotes to normal quotes, accented
+# e to e and em dash to dash
+# quote list from http://stackoverflow.com/questions/24358361/removing-u2018-and-u2019-character
+_CLEANSE_TABLE = {0x2018: u"'", 0x2019: u"'", 0x201c: u"'", 0x201d: u"'",
+                  0xe9: u"e", 0x2014: u"-"}
+# a url at the start of a word, and the rest of that word
+# regex pattern from http://stackoverflow.com/questions/6883049/regex-to-find-urls-in-string-in-python
+_URL_WORD_RE = re.compile(u"(?<![^ ])http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+[^ ]*")
+# tweets per process pool task in cleanse_texts
+_CLEANSE_CHUNK = 20000
+
+
+def cleanse_text(text):
+    """ Replaces "bad" quotes, accents and dashes in text, removes other
+        non-ascii characters and drops words that start with a url
+
+        Works on the whole text at once: words are first re-joined with single
+        spaces, so every later pass keeps the word boundaries of the original
+        word-by-word cleansing (a dropped word still leaves its space).
+
+        Inputs:
+            string -- text -- tweet text
+        Returns:
+            string -- cleansed text
+    """
+    text = u" ".join(text.split()).translate(_CLEANSE_TABLE)
+    text = text.encode("ascii", "ignore").decode("ascii")
+    return _URL_WORD_RE.sub(u"", text)
+
+
+def _cleanse_chunk(texts):
+    return [cleanse_text(t) for t in texts]
+
+
+def cleanse_texts(texts, num_workers=None):
+    """ Cleanses a list of tweet texts (see cleanse_text), in chunks across a
+        process pool when there are many of them
+
+        Inputs:
+            list of strings -- texts -- tweet texts
+            int -- num_workers -- number of processes; defaults to cpu count
+        Returns:
+            list of strings -- cleansed texts, in order
+    """
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    if num_workers <= 1 or len(texts) <= _CLEANSE_CHUNK:
+        return _cleanse_chunk(texts)
+    chunks = [texts[i:i + _CLEANSE_CHUNK]
+              for i in range(0, len(texts), _CLEANSE_CHUNK)]
+    pool = multiprocessing.Pool(min(num_workers, len(chunks)))
+    try:
+        cleansed = pool.map(_cleanse_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    return [t for chunk in cleansed for t in chunk]
+
+
+def cleanse_tweets(tweets, num_workers=None):
     """ identify and replace urls and unicode \u2018, \u2019 in tweets
 
         Inputs:
-            list of strings -- tweets -- list of tweets
+            list of status objects or TweetColumns -- tweets -- list of tweets
+            int -- num_workers -- number of processes (see cleanse_texts)
         Returns:
-            list of strings -- tweets with urls replaced with "URL"
-    """
-    cleansed = []
-    # set up url regex
-    # regex pattern from http://stackoverflow.com/questions/6883049/regex-to-find-urls-in-string-in-python
-    regURL = re.compile('http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
-    # for each tweet object find and replace any urls
-    for tweet in tweets:
-        # split tweet into list
-        tList = tweet.text.split()
-        for i in range(len(tList)):
-            # replace "bad" quotes with normal quotes
-            # regex pattern from http://stackoverflow.com/questions/24358361/removing-u2018-and-u2019-character
-            tList[i] = re.sub(u"(\u2018|\u2019|\u201c|\u201d)", "'", tList[i])
-            tList[i] = re.sub(u"(\xe9)", "e", tList[i])
-            tList[i] = re.sub(u"(\u2014)", "-", tList[i])
-            # remove other non-ascii unicode
-            tList[i] = re.sub(r'[^\x00-\x7F]+', '', tList[i])
-            match = regURL.match(tList[i])
-            if match:
-                #tList[i] = "URL"
-                tList[i] = ""
-        # rejoin updated list into string, add to cleansed list
-        tweet.text = ' '.join(tList)
-        cleansed.append(tweet)
-    return cleansed
+            list of status objects or TweetColumns -- tweets with urls removed
+                from their text
+    """
+    if isinstance(tweets, tweet_store.TweetColumns):
+        tweets.set_texts(cleanse_texts(tweets.texts(), num_workers))
+        return tweets
+    texts = cleanse_texts([tweet.text for tweet in tweets], num_workers)
+    for tweet, text in zip(tweets, texts):
+        tweet.text = text
+    return list(tweets)
+
+
+def _write_split(contexts, textById, user_path, context_path):
+    """ Writes one user tweet and its joined context per line, for every entry
+        of contexts, in a single pass over it
+
+        Returns:
+            int -- number of bytes written (the size of both files)
+    """
+    with open(user_path, "w+", _WRITE_BUFFER) as user_file:
+        with open(context_path, "w+", _WRITE_BUFFER) as context_file:
+            for tweetid, context in contexts.items():
+                user_line = textById[tweetid] + "\n"
+                # every context tweet is preceded by a space
+                if context:
+                    context_line = " " + " ".join([t.text for t in context]) + "\n"
+                else:
+                    context_line = "\n"
+                user_file.write(user_line)
+                context_file.write(context_line)
+    # text mode encodes the lines, so their lengths are not byte counts
+    return os.path.getsize(user_path) + os.path.getsize(context_path)
 
 
 def data_to_file(tweets, tweetsTest, alltweets, user_path_train, context_path_train, user_path_dev, context_path_dev):
@@ -395,62 +1104,119 @@ def data_to_file(tweets, tweetsTest, alltweets, user_path_train, context_path_tr
 
         Returns:
     """
+    start = time.time()
+    # look up the text of user tweets by id
+    userTweets = alltweets[0]
+    if isinstance(userTweets, tweet_store.TweetColumns):
+        textById = dict(zip(userTweets.ids.tolist(), userTweets.texts()))
+    else:
+        textById = dict((t.id, t.text) for t in userTweets)
     # write in train data
-    # open user file name
-    user_file = open(user_path_train, "w+")
-    # place user tweets - one per line - in a file
-    for tweetid in tweets:
-        # get text of tweet with tweetid from user
-        for t in alltweets[0]:
-            if t.id == tweetid:
-                tweet = t.text
-                break
-        # add string to file
-        user_file.write(tweet + "\n")
-    user_file.close()
-    # open context file name
-    context_file = open(context_path_train, "w+")
-    # place context tweets - one per "time" - in a file
-    for tid, c in tweets.iteritems():
-        # concatenate all context tweets into one string
-        tweet = ""
-        for t in c:
-            tweet = tweet + " " + t.text
-        # write mega-tweet to file
-        context_file.write(tweet + "\n")
-    context_file.close()
-
+    written = _write_split(tweets, textById, user_path_train, context_path_train)
     # write in test data
-    user_file_dev = open(user_path_dev, "w+")
-    # place user dev tweets - one per line - in a file
-    for tweetid in tweetsTest:
-        # get text of tweet with tweetid from user
-        for t in alltweets[0]:
-            if t.id == tweetid:
-                tweet = t.text
-                break
-        # add string to file
-        user_file_dev.write(tweet + "\n")
-    user_file_dev.close()
-
-    # open context dev file name
-    context_file_dev = open(context_path_dev, "w+")
-    # place context tweets - one per "time" - in a file
-    for tid, c in tweetsTest.iteritems():
-        # concatenate all context tweets into one string
-        tweet = ""
-        for t in c:
-            tweet = tweet + " " + t.text
-        # write mega-tweet to file
-        context_file_dev.write(tweet + "\n")
-    context_file_dev.close()
-
-
-def download_and_prepare():
+    written += _write_split(tweetsTest, textById, user_path_dev, context_path_dev)
+    elapsed = max(time.time() - start, 1e-9)
+    print("wrote %d bytes in %.2fs (%.1f MB/s)"
+          % (written, elapsed, written / elapsed / (1 << 20)))
+
+
+def _tokenizer_key(tokenizer):
+    """ Returns a hash identifying tokenizer (None: basic_tokenizer) """
+    if tokenizer is None:
+        return stage_cache.hash_values(_TOKEN_RE.pattern,
+                                       stage_cache.hash_function(basic_tokenizer))
+    if hasattr(tokenizer, "cache_key"):
+        return tokenizer.cache_key()
+    try:
+        return stage_cache.hash_function(tokenizer)
+    except (IOError, TypeError):
+        return stage_cache.hash_values(tokenizer.__module__, tokenizer.__name__)
+
+
+def _cached_vocabulary(cache, vocabulary_path, data_path, tokenizer=None,
+                       normalize_digits=True):
+    """ Runs create_vocabulary_parallel unless the manifest shows the
+        vocabulary was built from the same data file and parameters
+    """
+    key = stage_cache.hash_values(stage_cache.hash_file(data_path), vocab_size,
+                                  normalize_digits, _tokenizer_key(tokenizer))
+    stage = "vocab:" + vocabulary_path
+    outputs = [vocabulary_path, vocabulary_path + ".counts",
+               vocabulary_path + _COMPILED_SUFFIX]
+    if cache.is_fresh(stage, key, outputs):
+        return
+    cache.invalidate(stage, outputs)
+    create_vocabulary_parallel(vocabulary_path, data_path, vocab_size, tokenizer,
+                               normalize_digits)
+    compile_vocabulary(vocabulary_path)
+    cache.record(stage, key, outputs)
+
+
+def _cached_token_ids(cache, data_path, corpus_path, vocabulary_path,
+                      tokenizer=None, normalize_digits=True):
+    """ Runs data_to_token_ids_binary unless the manifest shows the corpus was
+        built from the same data file, vocabulary and parameters
+    """
+    key = stage_cache.hash_values(stage_cache.hash_file(data_path),
+                                  stage_cache.hash_file(vocabulary_path),
+                                  normalize_digits, _tokenizer_key(tokenizer))
+    stage = "tokenize:" + corpus_path
+    outputs = list(token_ids_paths(corpus_path))
+    if cache.is_fresh(stage, key, outputs):
+        return
+    cache.invalidate(stage, outputs)
+    data_to_token_ids_binary(data_path, corpus_path, vocabulary_path, tokenizer,
+                             normalize_digits)
+    cache.record(stage, key, outputs)
+
+
+def _cached_bpe(cache, data_paths, num_merges):
+    """ Runs learn_bpe unless the manifest shows the merges were learned from
+        the same data files and parameters
+
+        Returns:
+            the BPETokenizer of the merges
+    """
+    merges_path = bpe_merges_path(num_merges)
+    key = stage_cache.hash_values(
+        num_merges, stage_cache.hash_function(bpe.learn_merges, learn_bpe),
+        _tokenizer_key(None), *[stage_cache.hash_file(p) for p in data_paths])
+    stage = "bpe:" + merges_path
+    if not cache.is_fresh(stage, key, [merges_path]):
+        cache.invalidate(stage, [merges_path])
+        learn_bpe(merges_path, data_paths, num_merges)
+        cache.record(stage, key, [merges_path])
+    return bpe_tokenizer(num_merges)
+
+
+def tokenization_tag(bpe_merges):
+    """ Returns the part of the vocabulary and corpus names that tells their
+        tokenization apart ("" for basic_tokenizer)
+    """
+    return ".bpe%d" % bpe_merges if bpe_merges else ""
+
+
+def prepared_paths(bpe_merges=0):
+    """Returns the paths download_and_prepare returns, without preparing
+    anything (for runs that share data prepared once beforehand)."""
+    train_path = os.path.join("train_dir", "train")
+    dev_path = os.path.join("train_dir", "test1")
+    tag = tokenization_tag(bpe_merges)
+    return (train_path + (".ids%d%s.user" % (vocab_size, tag)),
+            train_path + (".ids%d%s.context" % (vocab_size, tag)),
+            dev_path + (".ids%d%s.context" % (vocab_size, tag)),
+            dev_path + (".ids%d%s.user" % (vocab_size, tag)),
+            os.path.join("tweet_data", "vocab%d%s.context" % (vocab_size, tag)),
+            os.path.join("tweet_data", "vocab%d%s.user" % (vocab_size, tag)))
+
+
+def download_and_prepare(bpe_merges=0):
     """Get tweet data into data_dir (TODO??????), create vocabularies and tokenize data.
 
     Inputs:
-        none
+        int -- bpe_merges -- if nonzero, tokenize into subwords with this many
+            BPE merges learned from both data files (see bpe) instead of
+            with basic_tokenizer
 
     Returns:
     A tuple of 6 elements:
@@ -469,35 +1235,15 @@ def download_and_prepare():
     news4 = 3108351  # @WSJ
     news5 = 2467791  # @washingtonpost
 
-    # grab all tweets from user
-    userHistory = []
-    tu = threading.Thread(target=get_all_tweets, args=(user, userHistory))
-    # get all tweets from context users
-    news1History = []
-    t1 = threading.Thread(target=get_all_tweets, args=(news1, news1History))
-    news2History = []
-    t2 = threading.Thread(target=get_all_tweets, args=(news2, news2History))
-    news3History = []
-    t3 = threading.Thread(target=get_all_tweets, args=(news3, news3History))
-    news4History = []
-    t4 = threading.Thread(target=get_all_tweets, args=(news4, news4History))
-    news5History = []
-    t5 = threading.Thread(target=get_all_tweets, args=(news5, news5History))
-
-    # run threads
-    threads = [tu, t1, t2, t3, t4, t5]
-    for th in threads:
-        th.start()
-    for th in threads:
-        th.join()
-
-    # clean urls of all tweets
-    allTweets = [userHistory, news1History, news2History, news3History, news4History, news5History]
-    for i in range(len(allTweets)):
-        allTweets[i] = cleanse_tweets(allTweets[i])
-
-    # construct context dict for train and test
-    context_dict, context_dict_valid = group_by_date(allTweets)
+    # bring the local tweet store up to date
+    accounts = [user, news1, news2, news3, news4, news5]
+    store = tweet_store.TweetStore(os.path.join("tweet_data", "tweets.db"))
+    stats = fetch_scheduler.update_accounts(store, accounts, api)
+    if stats["failed"]:
+        # their stored tweets are used as they are; the next run retries
+        print("WARNING: could not update accounts %s, preparing their "
+              "previously stored tweets" % ", ".join(map(str, stats["failed"])))
+    allTweets = [store.tweets(account) for account in accounts]
 
     ##############################################################################
     # some of the following code adapted from tensorflow example file data_utils #
@@ -513,27 +1259,61 @@ def download_and_prepare():
     user_file_path = os.path.join(data_dir, "data.user")
     context_file_path = os.path.join(data_dir, "data.context")
 
-    # move data into expected directories/make data available
-    data_to_file(context_dict, context_dict_valid, allTweets, user_file_path, context_file_path, dev_path + ".user", dev_path + ".context")
+    # every stage below is skipped while its inputs, parameters and code are
+    # unchanged since it last ran (see stage_cache)
+    cache = stage_cache.StageCache(os.path.join(data_dir, "manifest.json"))
+
+    # cleanse, group and write only keep their results in memory until they
+    # reach the data files, so their keys form one chain and they are skipped
+    # together when the data files are up to date
+    cleanse_key = stage_cache.hash_values(
+        stage_cache.hash_tweets(allTweets), _URL_WORD_RE.pattern,
+        sorted(_CLEANSE_TABLE.items()),
+        stage_cache.hash_function(cleanse_tweets, cleanse_texts, cleanse_text))
+    group_key = stage_cache.hash_values(cleanse_key, stage_cache.hash_function(
+        group_by_date, align_sources, align_by_date, tweet_epochs))
+    write_key = stage_cache.hash_values(group_key, stage_cache.hash_function(
+        data_to_file, _write_split))
+    write_outputs = [user_file_path, context_file_path,
+                     dev_path + ".user", dev_path + ".context"]
+    if cache.is_fresh("write", write_key, write_outputs):
+        print("data files up to date, skipping cleanse/group/write")
+    else:
+        # clean urls of all tweets
+        for i in range(len(allTweets)):
+            allTweets[i] = cleanse_tweets(allTweets[i])
+
+        # construct context dict for train and test
+        context_dict, context_dict_valid = group_by_date(allTweets)
+
+        # move data into expected directories/make data available
+        data_to_file(context_dict, context_dict_valid, allTweets, user_file_path, context_file_path, dev_path + ".user", dev_path + ".context")
+        cache.record("write", write_key, write_outputs)
+
+    tokenizer = None  # None: use default tokenizer
+    if bpe_merges:
+        tokenizer = _cached_bpe(cache, [context_file_path, user_file_path],
+                                bpe_merges)
+    tag = tokenization_tag(bpe_merges)
 
-    user_path = os.path.join(data_dir, "vocab%d.user" % vocab_size)
-    context_path = os.path.join(data_dir, "vocab%d.context" % vocab_size)
-    create_vocabulary(context_path, context_file_path, vocab_size, None)  # None: user default tokenizer
-    create_vocabulary(user_path, user_file_path, vocab_size, None)
+    user_path = os.path.join(data_dir, "vocab%d%s.user" % (vocab_size, tag))
+    context_path = os.path.join(data_dir, "vocab%d%s.context" % (vocab_size, tag))
+    _cached_vocabulary(cache, context_path, context_file_path, tokenizer)
+    _cached_vocabulary(cache, user_path, user_file_path, tokenizer)
 
     # Create token ids for the training data.
-    user_train_ids_path = train_path + (".ids%d.user" % vocab_size)
-    context_train_ids_path = train_path + (".ids%d.context" % vocab_size)
-    data_to_token_ids(user_file_path, user_train_ids_path, user_path, None)
-    data_to_token_ids(context_file_path, context_train_ids_path, context_path, None)
+    user_train_ids_path = train_path + (".ids%d%s.user" % (vocab_size, tag))
+    context_train_ids_path = train_path + (".ids%d%s.context" % (vocab_size, tag))
+    _cached_token_ids(cache, user_file_path, user_train_ids_path, user_path, tokenizer)
+    _cached_token_ids(cache, context_file_path, context_train_ids_path, context_path, tokenizer)
 
     print("made it")
 
     # Create token ids for the development data.
-    user_dev_ids_path = dev_path + (".ids%d.user" % vocab_size)
-    context_dev_ids_path = dev_path + (".ids%d.context" % vocab_size)
-    data_to_token_ids(dev_path + ".user", user_dev_ids_path, user_path, None)
-    data_to_token_ids(dev_path + ".context", context_dev_ids_path, context_path, None)
+    user_dev_ids_path = dev_path + (".ids%d%s.user" % (vocab_size, tag))
+    context_dev_ids_path = dev_path + (".ids%d%s.context" % (vocab_size, tag))
+    _cached_token_ids(cache, dev_path + ".user", user_dev_ids_path, user_path, tokenizer)
+    _cached_token_ids(cache, dev_path + ".context", context_dev_ids_path, context_path, tokenizer)
 
     # TODO return paths to directories of input and output
     return (user_train_ids_path, context_train_ids_path,
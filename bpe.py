@@ -0,0 +1,176 @@
+"""Byte-pair-encoding subword tokenizer for the data preparation pipeline.
+
+basic_tokenizer makes every handle, hashtag and rare name its own vocabulary
+entry. learn_merges starts from the bytes of every word of the data files and
+repeatedly merges the most frequent pair of adjacent symbols; BPETokenizer
+splits words into the learned subwords, so frequent words stay whole while
+rare ones are spelled out of a few thousand pieces. The vocabulary stays
+small and nearly nothing maps to _UNK_ (only bytes never seen in training).
+Every subword but the last of a word ends in MARKER, which is how decode joins
+the words back together:
+
+    b"#breakingnews" -> [b"#@@", b"breaking@@", b"news"]
+
+A BPETokenizer is a drop-in tokenizer= for bot.create_vocabulary_parallel,
+bot.data_to_token_ids_binary and bot.sentence_to_token_ids.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import heapq
+
+import stage_cache
+
+MARKER = b"@@"
+
+
+def _symbols(word):
+    """ Returns the single-byte symbols of a word """
+    return [word[i:i + 1] for i in range(len(word))]
+
+
+def _merge(symbols, pair, merged):
+    """ Returns symbols with every occurrence of pair replaced by merged """
+    first, second = pair
+    out = []
+    i, n = 0, len(symbols)
+    while i < n:
+        if i < n - 1 and symbols[i] == first and symbols[i + 1] == second:
+            out.append(merged)
+            i += 2
+        else:
+            out.append(symbols[i])
+            i += 1
+    return out
+
+
+def learn_merges(word_counts, num_merges, min_count=2):
+    """ Learns up to num_merges merges from word frequencies
+
+        Pair counts are kept up to date incrementally: a merge only touches
+        the words that contain its pair, and a heap with lazily dropped stale
+        entries finds the next most frequent pair.
+
+        Inputs:
+            dictionary -- word_counts -- word (bytes) to count
+            int -- num_merges -- number of merges to learn
+            int -- min_count -- stop once the most frequent pair is rarer
+        Returns:
+            list of (first, second) symbol pairs, in the order learned
+    """
+    words = [_symbols(w) for w in word_counts]
+    counts = list(word_counts.values())
+    pair_counts = collections.defaultdict(int)
+    where = collections.defaultdict(set)
+    for i, symbols in enumerate(words):
+        for pair in zip(symbols, symbols[1:]):
+            pair_counts[pair] += counts[i]
+            where[pair].add(i)
+    heap = [(-c, pair) for pair, c in pair_counts.items()]
+    heapq.heapify(heap)
+
+    merges = []
+    while heap and len(merges) < num_merges:
+        negative_count, pair = heapq.heappop(heap)
+        if pair_counts.get(pair, 0) != -negative_count:
+            continue  # stale, the pair's current count is queued as well
+        if -negative_count < min_count:
+            break
+        merges.append(pair)
+        merged = pair[0] + pair[1]
+        changed = set()
+        for i in where.pop(pair):
+            symbols = words[i]
+            new = _merge(symbols, pair, merged)
+            if len(new) == len(symbols):
+                continue
+            count = counts[i]
+            for p in zip(symbols, symbols[1:]):
+                pair_counts[p] -= count
+                changed.add(p)
+            for p in zip(new, new[1:]):
+                pair_counts[p] += count
+                where[p].add(i)
+                changed.add(p)
+            words[i] = new
+        for p in changed:
+            count = pair_counts[p]
+            if count > 0:
+                heapq.heappush(heap, (-count, p))
+            else:
+                del pair_counts[p]
+    return merges
+
+
+def save_merges(path, merges):
+    """ Writes merges one "first second" pair per line """
+    with open(path, "wb") as f:
+        f.write(b"".join(first + b" " + second + b"\n" for first, second in merges))
+
+
+def load_merges(path):
+    """ Returns the merges saved in path as a list of pairs """
+    with open(path, "rb") as f:
+        return [tuple(line.rstrip(b"\n").split(b" ")) for line in f]
+
+
+def decode(tokens):
+    """ Joins subword tokens (bytes) back into space-separated words """
+    text = b" ".join(tokens).replace(MARKER + b" ", b"")
+    if text.endswith(MARKER):
+        text = text[:-len(MARKER)]
+    return text
+
+
+class BPETokenizer(object):
+    """ Splits sentences into the subwords of a list of merges
+
+        Words are segmented once and memoized, so tokenizing a corpus costs a
+        dictionary lookup per word after the first few thousand lines.
+
+        Inputs:
+            list -- merges -- symbol pairs, as returned by learn_merges
+            function -- words -- splits a sentence (bytes) into words; must
+                match the word split the merges were learned on and be
+                picklable (module level) for multi-process counting
+            int -- max_cache -- most words to memoize
+    """
+
+    def __init__(self, merges, words, max_cache=1 << 20):
+        self.merges = merges
+        self.ranks = dict((pair, rank) for rank, pair in enumerate(merges))
+        self.words = words
+        self.max_cache = max_cache
+        self.cache = {}
+
+    def segment(self, word):
+        """ Returns the subwords of a word, all but the last ending in MARKER """
+        ranks = self.ranks
+        symbols = _symbols(word)
+        while len(symbols) > 1:
+            # apply the earliest learned merge first, as training did
+            pair = min(zip(symbols, symbols[1:]),
+                       key=lambda p: ranks.get(p, len(ranks)))
+            if pair not in ranks:
+                break
+            symbols = _merge(symbols, pair, pair[0] + pair[1])
+        return [s + MARKER for s in symbols[:-1]] + symbols[-1:]
+
+    def __call__(self, sentence):
+        cache = self.cache
+        tokens = []
+        for word in self.words(sentence):
+            subwords = cache.get(word)
+            if subwords is None:
+                subwords = self.segment(word)
+                if len(cache) < self.max_cache:
+                    cache[word] = subwords
+            tokens.extend(subwords)
+        return tokens
+
+    def cache_key(self):
+        """ Returns a hash identifying the tokenization, for stage_cache """
+        return stage_cache.hash_values(
+            self.merges, stage_cache.hash_function(BPETokenizer, self.words))
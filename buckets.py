@@ -0,0 +1,196 @@
+"""Data-driven bucket layouts for graph.py.
+
+Reads the source/target token-id corpora, prints a length histogram, picks the
+bucket boundaries that minimize the number of padded tokens for a given number
+of buckets, reports padding waste and dropped pairs, and saves the layout as a
+JSON file that graph.py loads with --buckets_file.
+
+    python buckets.py --source train_dir/train.ids500000.context \
+        --target train_dir/train.ids500000.user --num_buckets 4 \
+        --output tweet_data/buckets.json
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+
+import numpy as np
+
+import bot
+
+
+def pair_lengths(source_path, target_path):
+    """ Returns the source lengths and target lengths (EOS included, as
+        read_data appends it) of the aligned lines of two token-id corpora
+
+        Returns:
+            pair of numpy int64 arrays
+    """
+    source_offsets = bot.load_token_ids(source_path)[1]
+    target_offsets = bot.load_token_ids(target_path)[1]
+    num_lines = min(len(source_offsets), len(target_offsets)) - 1
+    return (np.diff(source_offsets[:num_lines + 1]),
+            np.diff(target_offsets[:num_lines + 1]) + 1)
+
+
+def assign_buckets(source_lens, target_lens, buckets):
+    """ Returns the bucket of every pair as read_data assigns it (the first
+        bucket with len(source) < size and len(target) < size), -1 for pairs
+        that fit no bucket
+    """
+    assigned = np.full(len(source_lens), -1, dtype=np.int64)
+    for bucket_id in reversed(range(len(buckets))):
+        source_size, target_size = buckets[bucket_id]
+        assigned[(source_lens < source_size) & (target_lens < target_size)] = bucket_id
+    return assigned
+
+
+def bucket_report(source_lens, target_lens, buckets):
+    """ Returns padding statistics of a bucket layout
+
+        Returns:
+            dictionary -- buckets, pairs per bucket, dropped pairs, real and
+                padded (source + target) tokens and the padding fraction
+    """
+    assigned = assign_buckets(source_lens, target_lens, buckets)
+    kept = assigned >= 0
+    sizes = np.array([s + t for s, t in buckets], dtype=np.int64)
+    real = int(source_lens[kept].sum() + target_lens[kept].sum())
+    padded = int(sizes[assigned[kept]].sum()) if len(buckets) else 0
+    return {"buckets": [list(b) for b in buckets],
+            "pairs": np.bincount(assigned[kept], minlength=len(buckets)).tolist(),
+            "dropped": int((~kept).sum()),
+            "real_tokens": real,
+            "padded_tokens": padded,
+            "padding_fraction": 1.0 - real / padded if padded else 0.0}
+
+
+def choose_buckets(source_lens, target_lens, num_buckets,
+                   max_source_length=None, max_target_length=None):
+    """ Picks the bucket layout with the fewest padded tokens
+
+        Buckets split the pairs by source length. Every bucket must be at
+        least as large as the previous one in both dimensions (the model is
+        built around the last, largest bucket), so a bucket's target size is
+        set by the longest target of all pairs up to and including it. With
+        that, dynamic programming over the distinct source lengths gives the
+        exact optimum.
+
+        Inputs:
+            numpy array -- source_lens -- source length of every pair
+            numpy array -- target_lens -- target length (EOS included)
+            int -- num_buckets -- number of buckets to use (at most)
+            int -- max_source_length, max_target_length -- longer pairs are
+                dropped instead of growing the last bucket
+        Returns:
+            list of (source_size, target_size) tuples
+    """
+    keep = np.ones(len(source_lens), dtype=bool)
+    if max_source_length:
+        keep &= source_lens <= max_source_length
+    if max_target_length:
+        keep &= target_lens <= max_target_length
+    source_lens, target_lens = source_lens[keep], target_lens[keep]
+    if len(source_lens) == 0:
+        return []
+    # distinct source lengths with their pair counts and longest targets
+    lengths, inverse = np.unique(source_lens, return_inverse=True)
+    counts = np.bincount(inverse).astype(np.float64)
+    longest = np.zeros(len(lengths), dtype=np.int64)
+    np.maximum.at(longest, inverse, target_lens)
+    prefix_longest = np.maximum.accumulate(longest)
+    prefix_counts = np.concatenate([[0.0], np.cumsum(counts)])
+
+    # padded size of a bucket whose longest source is distinct length j
+    sizes = (lengths + 1) + (prefix_longest + 1)
+
+    num = len(lengths)
+    num_buckets = max(1, min(num_buckets, num))
+    # best[k, j]: fewest padded tokens for distinct lengths 0..j in k buckets
+    best = np.full((num_buckets + 1, num), np.inf)
+    split = np.zeros((num_buckets + 1, num), dtype=np.int64)
+    best[1] = prefix_counts[1:] * sizes
+    for k in range(2, num_buckets + 1):
+        for j in range(k - 1, num):
+            # the last bucket covers starts..j, the k - 1 before it the rest
+            starts = np.arange(k - 1, j + 1)
+            candidates = (best[k - 1, starts - 1] +
+                          (prefix_counts[j + 1] - prefix_counts[starts]) * sizes[j])
+            i = int(np.argmin(candidates))
+            best[k, j] = candidates[i]
+            split[k, j] = starts[i]
+    ends = []
+    j, k = num - 1, num_buckets
+    while k > 0:
+        ends.append(j)
+        j = split[k, j] - 1
+        k -= 1
+    return [(int(lengths[j]) + 1, int(prefix_longest[j]) + 1)
+            for j in reversed(ends)]
+
+
+def print_histogram(lengths, name, bin_size=25):
+    """ Prints a text histogram of lengths """
+    if len(lengths) == 0:
+        return
+    counts = np.bincount(lengths // bin_size)
+    scale = 50.0 / counts.max()
+    print("%s length histogram:" % name)
+    for b, c in enumerate(counts):
+        print("  %4d-%-4d %8d %s" % (b * bin_size, (b + 1) * bin_size - 1, c,
+                                    "#" * int(round(c * scale))))
+
+
+def print_report(report, name):
+    print("%s: buckets %s" % (name, report["buckets"]))
+    print("  pairs per bucket %s, dropped %d" % (report["pairs"], report["dropped"]))
+    print("  real tokens %d, padded tokens %d, padding %.1f%%"
+          % (report["real_tokens"], report["padded_tokens"],
+             100.0 * report["padding_fraction"]))
+
+
+def save_buckets(path, buckets, report=None):
+    """ Saves a bucket layout (and optionally its report) as JSON """
+    layout = dict(report or {})
+    layout["buckets"] = [list(b) for b in buckets]
+    with open(path, "w") as f:
+        json.dump(layout, f, indent=1, sort_keys=True)
+
+
+def load_buckets(path):
+    """ Returns the bucket layout saved in path as a list of tuples """
+    with open(path) as f:
+        return [tuple(b) for b in json.load(f)["buckets"]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--source", required=True, help="source token-id corpus")
+    parser.add_argument("--target", required=True, help="target token-id corpus")
+    parser.add_argument("--num_buckets", type=int, default=4)
+    parser.add_argument("--max_source_length", type=int, default=0)
+    parser.add_argument("--max_target_length", type=int, default=0)
+    parser.add_argument("--compare", default="",
+                        help="bucket layout file to report on for comparison")
+    parser.add_argument("--output", default="", help="where to save the layout")
+    args = parser.parse_args()
+
+    source_lens, target_lens = pair_lengths(args.source, args.target)
+    print_histogram(source_lens, "source")
+    print_histogram(target_lens, "target")
+    if args.compare:
+        print_report(bucket_report(source_lens, target_lens,
+                                   load_buckets(args.compare)), "current")
+    buckets = choose_buckets(source_lens, target_lens, args.num_buckets,
+                             args.max_source_length, args.max_target_length)
+    report = bucket_report(source_lens, target_lens, buckets)
+    print_report(report, "chosen")
+    if args.output:
+        save_buckets(args.output, buckets, report)
+        print("saved bucket layout to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
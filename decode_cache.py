@@ -0,0 +1,113 @@
+"""LRU cache of decode results, keyed by token ids and checkpoint.
+
+Repeated contexts (the same headline from several outlets, say) decode to the
+same output as long as the model does not change, so graph.decode_batches
+looks every bucketed input up here first. Entries are tied to the identity of
+the checkpoint they were decoded with; switching checkpoints drops them.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import sqlite3
+import threading
+from contextlib import closing
+
+
+def decode_key(bucket_id, token_ids, *settings):
+    """ Returns the cache key of a bucketed input: its bucket, the token ids
+        the model sees and any decode settings (e.g. beam width)
+    """
+    return "%d|%s|%s" % (bucket_id, ",".join([str(t) for t in token_ids]),
+                         ",".join([repr(s) for s in settings]))
+
+
+class DecodeCache(object):
+    """ In-process LRU cache of decode outputs, optionally backed by SQLite.
+
+        Memory holds at most max_entries outputs. With a disk path, every
+        output is also written there and memory misses fall back to it, so
+        results survive restarts of the decoding process.
+    """
+
+    def __init__(self, max_entries=10000, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.checkpoint = None
+        self.entries = collections.OrderedDict()
+        self.hits, self.misses, self.disk_hits = 0, 0, 0
+        self.lock = threading.Lock()
+        if path:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS outputs ("
+                             " checkpoint TEXT NOT NULL,"
+                             " key TEXT NOT NULL,"
+                             " output TEXT NOT NULL,"
+                             " PRIMARY KEY (checkpoint, key))")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    @staticmethod
+    def _disk_key(key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def set_checkpoint(self, checkpoint):
+        """ Ties the cache to checkpoint; entries of any other one are dropped """
+        with self.lock:
+            if checkpoint == self.checkpoint:
+                return
+            self.checkpoint = checkpoint
+            self.entries.clear()
+            if self.path:
+                with closing(self._connect()) as conn, conn:
+                    conn.execute("DELETE FROM outputs WHERE checkpoint != ?",
+                                 (checkpoint,))
+
+    def get(self, key):
+        """ Returns the cached output (list of token ids) for key, or None """
+        with self.lock:
+            output = self.entries.pop(key, None)
+            if output is not None:
+                self.entries[key] = output
+                self.hits += 1
+                return output
+            if self.path:
+                with closing(self._connect()) as conn:
+                    row = conn.execute("SELECT output FROM outputs WHERE"
+                                       " checkpoint = ? AND key = ?",
+                                       (self.checkpoint, self._disk_key(key))
+                                       ).fetchone()
+                if row is not None:
+                    output = [int(t) for t in row[0].split()]
+                    self._remember(key, output)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return output
+            self.misses += 1
+            return None
+
+    def put(self, key, output):
+        """ Caches output (list of token ids) for key """
+        with self.lock:
+            self._remember(key, output)
+            if self.path:
+                with closing(self._connect()) as conn, conn:
+                    conn.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?)",
+                                 (self.checkpoint, self._disk_key(key),
+                                  " ".join([str(t) for t in output])))
+
+    def _remember(self, key, output):
+        self.entries.pop(key, None)
+        self.entries[key] = output
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return ("decode cache: %d hits (%d from disk), %d misses, hit rate "
+                "%.1f%%, %d entries" % (self.hits, self.disk_hits, self.misses,
+                                        100.0 * self.hits / max(lookups, 1),
+                                        len(self.entries)))
@@ -0,0 +1,347 @@
+"""Long-lived local decoding server with dynamic micro-batching, on asyncio.
+
+graph.py --serve loads the checkpoint and vocabularies once and answers HTTP
+requests on a local port from one asyncio event loop. Every request hands its
+token-id sequences to a MicroBatcher, which queues them by bucket and takes a
+bucket's queue as one batch as soon as it holds a full batch or its oldest
+sequence has waited max_wait seconds. Batches run on a single executor thread,
+the only one that uses the TF session, while the event loop goes on accepting
+and queueing requests; bursts of concurrent requests so share model.step
+calls instead of decoding one sentence at a time.
+
+    POST /        one context per line; the reply has one output per line
+    GET /stats    JSON with p50/p99 latency, throughput and batch sizes
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import threading
+import time
+from http.client import responses
+
+import numpy as np
+
+
+class LatencyStats(object):
+    """ Latencies of the most recent window sequences, and totals """
+
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.sequences, self.batches = 0, 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def record_batch(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.sequences += len(latencies)
+            self.batches += 1
+
+    def summary(self):
+        """ Returns a dictionary of latency percentiles (ms), throughput and
+            mean batch size
+        """
+        with self.lock:
+            latencies = np.array(self.latencies)
+            sequences, batches = self.sequences, self.batches
+        elapsed = time.time() - self.start
+        p50, p99 = (np.percentile(latencies, [50, 99]) * 1000.0
+                    if len(latencies) else (0.0, 0.0))
+        return {"sequences": sequences,
+                "batches": batches,
+                "mean_batch_size": sequences / max(batches, 1),
+                "p50_ms": float(p50),
+                "p99_ms": float(p99),
+                "sequences_per_second": sequences / max(elapsed, 1e-9)}
+
+    def report(self):
+        s = self.summary()
+        return ("served %d sequences in %d batches (%.1f per batch): "
+                "p50 %.1fms, p99 %.1fms, %.1f sequences/s"
+                % (s["sequences"], s["batches"], s["mean_batch_size"],
+                   s["p50_ms"], s["p99_ms"], s["sequences_per_second"]))
+
+
+class ServerStopped(Exception):
+    """ The error of every sequence still waiting when the batcher stops """
+
+
+class _Pending(object):
+    """ One queued sequence and the future of its output """
+    __slots__ = ("token_ids", "arrival", "future")
+
+    def __init__(self, token_ids, future):
+        self.token_ids = token_ids
+        self.arrival = time.time()
+        self.future = future
+
+
+class MicroBatcher(object):
+    """ Collects sequences from concurrent requests into per-bucket batches
+        and decodes them on one executor thread.
+
+        Inputs:
+            function -- decode_fn -- list of token-id lists (all of one
+                bucket) to list of outputs; only ever called from the
+                executor thread, so it may use the TF session freely
+            function -- bucket_fn -- sequence length to bucket id
+            int -- batch_size -- sequences per batch
+            float -- max_wait -- seconds a sequence may wait for its batch
+                to fill up
+    """
+
+    def __init__(self, decode_fn, bucket_fn, batch_size, max_wait=0.01):
+        self.decode_fn = decode_fn
+        self.bucket_fn = bucket_fn
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queues = collections.defaultdict(collections.deque)
+        self.stats = LatencyStats()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.decoding = []  # the batch on the executor thread
+        self.stopped = False
+        self.loop, self.wakeup, self.task = None, None, None
+
+    async def start(self):
+        """ Starts batching on the running event loop """
+        self.loop = asyncio.get_event_loop()
+        self.wakeup = asyncio.Event()
+        self.task = self.loop.create_task(self._run())
+
+    async def decode(self, sequences, timeout=None):
+        """ Decodes a list of token-id lists, waiting for their batches
+
+            Returns:
+                list -- output token ids of every sequence
+            Raises:
+                asyncio.TimeoutError -- after timeout seconds (None: no
+                    limit); the sequences are dropped from their queues
+                ServerStopped -- the batcher stopped first
+                the error of decode_fn on a batch of the sequences
+        """
+        if self.stopped:
+            raise ServerStopped("the decoding server is stopping")
+        pending = [_Pending(s, self.loop.create_future()) for s in sequences]
+        for p in pending:
+            self.queues[self.bucket_fn(len(p.token_ids))].append(p)
+        self.wakeup.set()
+        results = await asyncio.wait_for(
+            asyncio.gather(*[p.future for p in pending], return_exceptions=True),
+            timeout)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def _next_batch(self):
+        """ Takes up to batch_size sequences from the bucket that is full or
+            has waited longest past its deadline
+
+            Returns:
+                pair -- the batch (None if no bucket is ready) and the time
+                    the next bucket becomes ready (None if all are empty)
+        """
+        now = time.time()
+        ready, deadline = None, None
+        for bucket_id, q in self.queues.items():
+            # sequences whose request timed out are dropped
+            while q and q[0].future.done():
+                q.popleft()
+            if not q:
+                continue
+            expires = q[0].arrival + self.max_wait
+            if len(q) >= self.batch_size or expires <= now:
+                # the bucket whose oldest sequence waited longest
+                if ready is None or q[0].arrival < self.queues[ready][0].arrival:
+                    ready = bucket_id
+            elif deadline is None or expires < deadline:
+                deadline = expires
+        if ready is None:
+            return None, deadline
+        q = self.queues[ready]
+        batch = []
+        while q and len(batch) < self.batch_size:
+            p = q.popleft()
+            if not p.future.done():
+                batch.append(p)
+        return batch, None
+
+    async def _run(self):
+        while not self.stopped:
+            batch, deadline = self._next_batch()
+            if not batch:
+                if batch is None:
+                    self.wakeup.clear()
+                    timeout = None if deadline is None else max(0.0, deadline - time.time())
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+            self.decoding = batch
+            try:
+                outputs = await self.loop.run_in_executor(
+                    self.executor, self.decode_fn, [p.token_ids for p in batch])
+            except Exception as e:  # pylint: disable=broad-except
+                self.decoding = []
+                for p in batch:
+                    if not p.future.done():
+                        p.future.set_exception(e)
+                continue
+            # still set if stop() cancelled the wait, for stop() to fail
+            self.decoding = []
+            now = time.time()
+            for p, output in zip(batch, outputs):
+                if not p.future.done():
+                    p.future.set_result(output)
+            self.stats.record_batch([now - p.arrival for p in batch])
+
+    async def stop(self):
+        """ Stops batching; every sequence still queued or decoding fails with
+            ServerStopped
+        """
+        self.stopped = True
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        waiting = list(self.decoding)
+        for q in self.queues.values():
+            waiting.extend(q)
+            q.clear()
+        for p in waiting:
+            if not p.future.done():
+                p.future.set_exception(ServerStopped("the decoding server stopped"))
+        # lets a batch still on the executor thread finish with the session
+        self.executor.shutdown(wait=True)
+
+
+class DecodeServer(object):
+    """ HTTP server answering every request on the event loop through a
+        shared MicroBatcher; one request per connection
+
+        Inputs:
+            MicroBatcher -- batcher
+            function -- encode -- list of byte lines to list of token-id lists
+            function -- to_text -- output token ids to a string
+            float -- request_timeout -- seconds a request may wait for its
+                outputs before it is answered with 503
+    """
+    # posting jobs connect in bursts
+    backlog = 128
+
+    def __init__(self, batcher, encode, to_text, request_timeout=60.0):
+        self.batcher = batcher
+        self.encode = encode
+        self.to_text = to_text
+        self.request_timeout = request_timeout
+        self.handlers = set()
+        self.loop, self.server = None, None
+
+    async def start(self, host, port):
+        """ Starts the batcher and listens on (host, port)
+
+            Returns:
+                pair -- the (host, port) listened on
+        """
+        self.loop = asyncio.get_event_loop()
+        await self.batcher.start()
+        self.server = await asyncio.start_server(self._connected, host, port,
+                                                 backlog=self.backlog)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        """ Stops listening, stops the batcher and waits (briefly) for the
+            replies to every open request, failed ones included
+        """
+        self.server.close()
+        await self.batcher.stop()
+        if self.handlers:
+            await asyncio.wait(list(self.handlers), timeout=5)
+        await self.server.wait_closed()
+
+    def _connected(self, reader, writer):
+        task = self.loop.create_task(self._handle(reader, writer))
+        self.handlers.add(task)
+        task.add_done_callback(self.handlers.discard)
+
+    async def _handle(self, reader, writer):
+        try:
+            status, body, content_type = await self._respond(reader, writer)
+        except (asyncio.IncompleteReadError, ValueError):
+            status, body, content_type = 400, "bad request", "text/plain"
+        body = body.encode("utf-8")
+        header = ("HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n"
+                  "Connection: close\r\n\r\n"
+                  % (status, responses.get(status, ""), content_type, len(body)))
+        try:
+            writer.write(header.encode("latin-1") + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, reader, writer):
+        """ Reads one request and returns its (status, body, content type) """
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) < 2:
+            raise ValueError("bad request line")
+        method, path = request_line[0], request_line[1]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if method == "GET":
+            if path.rstrip("/") != "/stats":
+                return 404, "not found", "text/plain"
+            return (200, json.dumps(self.batcher.stats.summary()),
+                    "application/json")
+        if method != "POST":
+            return 405, "method not allowed", "text/plain"
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        lines = (await reader.readexactly(int(headers.get("content-length", 0)))
+                 ).splitlines()
+        try:
+            outputs = await self.batcher.decode(self.encode(lines),
+                                                self.request_timeout)
+        except asyncio.TimeoutError:
+            return 503, "decoding timed out", "text/plain"
+        except ServerStopped as e:
+            return 503, str(e), "text/plain"
+        except Exception as e:  # pylint: disable=broad-except
+            return 500, str(e), "text/plain"
+        return (200, "".join([self.to_text(o) + "\n" for o in outputs]),
+                "text/plain; charset=utf-8")
+
+
+def serve(batcher, encode, to_text, host, port, request_timeout=60.0):
+    """ Serves decoding on (host, port) from a new event loop until
+        interrupted (Ctrl-C), then fails the requests still waiting and
+        stops the batcher
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = DecodeServer(batcher, encode, to_text, request_timeout)
+    try:
+        address = loop.run_until_complete(server.start(host, port))
+        print("serving on http://%s:%d" % address)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        loop.run_until_complete(server.close())
+    finally:
+        loop.close()
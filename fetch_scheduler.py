@@ -0,0 +1,221 @@
+"""Rate-limit-aware scheduler for fetching many timelines at once.
+
+Instead of one thread per account that pages through its timeline until done,
+every timeline page is a task. A bounded pool of worker threads takes tasks in
+round-robin order across accounts, and every call first takes one request
+from the per-endpoint rate-limit budget, waiting for the window to reset when
+the budget is used up.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+from six.moves import queue
+import tweepy
+
+import tweet_store
+
+TIMELINE_ENDPOINT = "/statuses/user_timeline"
+# user-auth limits for GET statuses/user_timeline: 900 calls per 15 minutes
+DEFAULT_LIMIT = 900
+DEFAULT_WINDOW = 15 * 60
+# shortest wait for a used-up budget, even if its reset time has passed
+MIN_WAIT = 1.0
+
+
+class RateLimitBudget(object):
+    """ Remaining request budget of each API endpoint, shared by all workers.
+
+        The budget is seeded from api.rate_limit_status() when the API has it
+        and otherwise assumes a fresh DEFAULT_LIMIT per DEFAULT_WINDOW window.
+    """
+
+    def __init__(self, api=None, limit=DEFAULT_LIMIT, window=DEFAULT_WINDOW):
+        self.api = api
+        self.limit = limit
+        self.window = window
+        self.remaining = {}  # endpoint -> calls left in the current window
+        self.reset = {}  # endpoint -> epoch seconds when the window resets
+        self.waited = 0.0  # seconds workers spent waiting, summed over workers
+        self.lock = threading.Lock()
+
+    def _refresh(self, endpoint):
+        """ Reloads the budget of endpoint, from the API if possible """
+        status = None
+        if hasattr(self.api, "rate_limit_status"):
+            try:
+                resources = self.api.rate_limit_status()["resources"]
+                family = endpoint.split("/")[1]
+                status = resources[family][endpoint]
+            except (tweepy.TweepError, KeyError, IndexError):
+                status = None
+        if status is not None:
+            self.remaining[endpoint] = status["remaining"]
+            self.reset[endpoint] = status["reset"]
+        else:
+            self.remaining[endpoint] = self.limit
+            self.reset[endpoint] = time.time() + self.window
+
+    def acquire(self, endpoint):
+        """ Takes one call from the budget of endpoint, sleeping until the
+            rate-limit window resets if it is used up
+
+            The sleep is at least MIN_WAIT, so an API that reports a used-up
+            budget with a reset time in the past is not polled in a busy
+            loop, and it happens outside the lock, so workers do not queue up
+            behind one sleeper.
+        """
+        while True:
+            with self.lock:
+                if endpoint not in self.remaining:
+                    self._refresh(endpoint)
+                if self.remaining[endpoint] > 0:
+                    self.remaining[endpoint] -= 1
+                    return
+                delay = max(self.reset[endpoint] - time.time() + 1, MIN_WAIT)
+            print("rate limit reached for %s, waiting %ds" % (endpoint, delay))
+            time.sleep(delay)
+            with self.lock:
+                self.waited += delay
+                # the first worker to wake up reloads the budget
+                if self.remaining[endpoint] <= 0:
+                    self._refresh(endpoint)
+
+    def exhaust(self, endpoint):
+        """ Marks the budget of endpoint used up (the API said so) """
+        with self.lock:
+            self.remaining[endpoint] = 0
+            if self.reset.get(endpoint, 0) <= time.time():
+                self.reset[endpoint] = time.time() + self.window
+
+
+class _Timeline(object):
+    """ Fetch state of one account: what to ask for next and what came back """
+
+    def __init__(self, account, since_id):
+        self.account = account
+        self.since_id = since_id
+        self.max_id = None
+        self.tweets = []
+        self.failures = 0
+
+    def request_kwargs(self):
+        kwargs = {"count": tweet_store.PAGE_SIZE}
+        if self.since_id is not None:
+            kwargs["since_id"] = self.since_id
+        if self.max_id is not None:
+            kwargs["max_id"] = self.max_id
+        return kwargs
+
+
+def fetch_timelines(api, accounts, since_ids=None, num_workers=8,
+                    budget=None, max_failures=3):
+    """ Fetches the timelines of many accounts with a bounded worker pool,
+        interleaving their pages and staying inside the rate limit
+
+        Inputs:
+            tweepy.API -- api -- anything with a tweepy-like user_timeline
+            list -- accounts -- account roster (user ids or screen names)
+            dictionary (account : int) -- since_ids -- newest known tweet id
+                per account; accounts missing from it are fetched in full
+            int -- num_workers -- number of concurrent requests
+            RateLimitBudget -- budget -- shared budget; a fresh one if None
+            int -- max_failures -- errors tolerated per account before it is
+                given up on
+        Returns:
+            dictionary (account : list of Status objects) -- fetched tweets,
+                newest first; for the accounts in stats["failed"] only the
+                pages that arrived before they were given up on
+            dictionary -- stats: pages, seconds, pages_per_second, failed
+    """
+    since_ids = since_ids or {}
+    if budget is None:
+        budget = RateLimitBudget(api)
+    tasks = queue.Queue()
+    for account in accounts:
+        tasks.put(_Timeline(account, since_ids.get(account)))
+    pending = [len(accounts)]
+    stats = {"pages": 0, "failed": []}
+    lock = threading.Lock()
+
+    def finish(timeline, failed=False):
+        with lock:
+            if failed:
+                stats["failed"].append(timeline.account)
+            pending[0] -= 1
+            if pending[0] == 0:
+                # wake every worker up so they can exit
+                for _ in range(num_workers):
+                    tasks.put(None)
+
+    def worker():
+        while True:
+            timeline = tasks.get()
+            if timeline is None:
+                return
+            try:
+                budget.acquire(TIMELINE_ENDPOINT)
+                page = api.user_timeline(timeline.account,
+                                         **timeline.request_kwargs())
+            except tweepy.RateLimitError:
+                budget.exhaust(TIMELINE_ENDPOINT)
+                tasks.put(timeline)
+                continue
+            except Exception as e:  # pylint: disable=broad-except
+                # any error (connection, a bad reply) counts against the
+                # account; a dead worker would leave the others waiting
+                timeline.failures += 1
+                print("account %s: %s" % (timeline.account, e))
+                if timeline.failures >= max_failures:
+                    finish(timeline, failed=True)
+                else:
+                    tasks.put(timeline)
+                continue
+            with lock:
+                stats["pages"] += 1
+            if len(page) == 0:
+                finish(timeline)
+                continue
+            timeline.tweets.extend(page)
+            timeline.max_id = timeline.tweets[-1].id - 1
+            # back of the queue, so every account gets its turn
+            tasks.put(timeline)
+
+    timelines = list(tasks.queue)
+    start = time.time()
+    if accounts:
+        workers = [threading.Thread(target=worker) for _ in range(num_workers)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+    stats["seconds"] = time.time() - start
+    stats["pages_per_second"] = stats["pages"] / max(stats["seconds"], 1e-9)
+    print("fetched %d pages from %d accounts in %.2fs (%.1f pages/s)"
+          % (stats["pages"], len(accounts), stats["seconds"],
+             stats["pages_per_second"]))
+    return dict((t.account, t.tweets) for t in timelines), stats
+
+
+def update_accounts(store, accounts, api, **kwargs):
+    """ Brings the timelines of all accounts in store up to date, asking only
+        for tweets newer than the ones already stored
+
+        Accounts whose fetch failed are left as they were: their partial pages
+        are the newest ones, and storing them would move the next run's
+        since_id past the tweets that never arrived.
+
+        Returns:
+            dictionary -- stats of fetch_timelines; stats["failed"] lists the
+                accounts that were not updated
+    """
+    since_ids = dict((account, store.max_id(account)) for account in accounts)
+    fetched, stats = fetch_timelines(api, accounts, since_ids, **kwargs)
+    failed = set(stats["failed"])
+    for account in accounts:
+        if account not in failed:
+            store.add(account, fetched[account])
+    return stats
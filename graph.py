@@ -28,20 +28,30 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bisect
 import math
 import os
 import random
 import sys
 import time
 import logging
+import threading
 
 import numpy as np
+import six
+from six.moves import queue
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
 #from tensorflow.models.rnn.translate import data_utils
 import bot
+import bpe
+import buckets
+import decode_cache
+import decode_server
+import train_profiler
 from tensorflow.models.rnn.translate import seq2seq_model
+from tensorflow.python.client import timeline
 
 
 tf.app.flags.DEFINE_float("learning_rate", 0.5, "Learning rate.")
@@ -55,18 +65,107 @@ tf.app.flags.DEFINE_integer("size", 1024, "Size of each model layer.")
 tf.app.flags.DEFINE_integer("num_layers", 3, "Number of layers in the model.")
 tf.app.flags.DEFINE_integer("en_vocab_size", 40000, "English vocabulary size.")
 tf.app.flags.DEFINE_integer("fr_vocab_size", 40000, "French vocabulary size.")
+tf.app.flags.DEFINE_float("vocab_coverage", 0.0,
+                          "Fit the vocabularies to the data: keep the most "
+                          "frequent tokens covering this fraction of all "
+                          "token occurrences (0: off).")
+tf.app.flags.DEFINE_integer("vocab_min_count", 0,
+                            "Fit the vocabularies to the data: drop tokens "
+                            "seen fewer times than this (0: off).")
+tf.app.flags.DEFINE_integer("bpe_merges", 0,
+                            "Tokenize into subwords with this many BPE "
+                            "merges learned from the data (0: whole words); "
+                            "8000-30000 give vocabularies of about 8-32k "
+                            "entries with next to no _UNK_.")
+tf.app.flags.DEFINE_integer("num_samples", 512,
+                            "Sampled softmax samples (0: full softmax); with "
+                            "fitted vocabularies, the full softmax is used "
+                            "when the output vocabulary is at most 4 times "
+                            "this.")
 tf.app.flags.DEFINE_string("data_dir", "/tmp", "Data directory")
 tf.app.flags.DEFINE_string("train_dir", "/tmp", "Training directory.")
 tf.app.flags.DEFINE_integer("max_train_data_size", 0,
                             "Limit on the size of training data (0: no limit).")
 tf.app.flags.DEFINE_integer("steps_per_checkpoint", 200,
                             "How many training steps to do per checkpoint.")
+tf.app.flags.DEFINE_integer("max_steps", 0,
+                            "Stop training after this many steps (0: never).")
+tf.app.flags.DEFINE_float("max_seconds", 0.0,
+                          "Stop training after this many seconds (0: never).")
+tf.app.flags.DEFINE_boolean("prepare_data", True,
+                            "Run bot.download_and_prepare before training; "
+                            "off to use data already prepared (sweep.py).")
+tf.app.flags.DEFINE_integer("intra_op_threads", 0,
+                            "Threads for parallelism inside an op "
+                            "(0: TensorFlow's default).")
+tf.app.flags.DEFINE_integer("inter_op_threads", 0,
+                            "Threads for running independent ops "
+                            "(0: TensorFlow's default).")
+tf.app.flags.DEFINE_boolean("async_checkpoint", False,
+                            "Write checkpoints from a snapshot of the "
+                            "variables in a background thread.")
+tf.app.flags.DEFINE_integer("steps_per_eval", -1,
+                            "How many training steps to do per dev eval "
+                            "(-1: with every checkpoint, 0: no dev eval).")
 tf.app.flags.DEFINE_boolean("decode", False,
                             "Set to True for interactive decoding.")
+tf.app.flags.DEFINE_string("decode_input", "",
+                           "With --decode, decode every line of this file "
+                           "in batches instead of reading stdin.")
+tf.app.flags.DEFINE_string("decode_output", "",
+                           "Where batch decoding writes its outputs "
+                           "(default: decode_input + '.out').")
+tf.app.flags.DEFINE_integer("beam_width", 1,
+                            "Beam width for decoding (1: greedy decoding); "
+                            "beam search costs a full model.step per output "
+                            "position. --batch_size must be a multiple of "
+                            "it for batch decoding and --serve.")
+tf.app.flags.DEFINE_float("length_penalty", 0.6,
+                          "Length normalization exponent for beam search.")
+tf.app.flags.DEFINE_integer("decode_cache_size", 10000,
+                            "Decode results kept in memory (0: none).")
+tf.app.flags.DEFINE_string("decode_cache_file", "",
+                           "SQLite file that also keeps decode results "
+                           "across runs (empty: memory only).")
+tf.app.flags.DEFINE_boolean("serve", False,
+                            "Serve decoding over HTTP on --serve_port.")
+tf.app.flags.DEFINE_string("serve_host", "127.0.0.1",
+                           "Address the decoding server listens on.")
+tf.app.flags.DEFINE_integer("serve_port", 8001,
+                            "Port the decoding server listens on.")
+tf.app.flags.DEFINE_float("max_wait_ms", 10.0,
+                          "How long a served sentence may wait for its "
+                          "bucket's batch to fill up.")
+tf.app.flags.DEFINE_float("request_timeout", 60.0,
+                          "Seconds a served request may wait for its "
+                          "outputs before it is answered with 503.")
 tf.app.flags.DEFINE_boolean("self_test", False,
                             "Run a self-test if this is set to True.")
 tf.app.flags.DEFINE_boolean("use_fp16", False,
                             "Train using fp16 instead of fp32.")
+tf.app.flags.DEFINE_boolean("prepad_buckets", False,
+                            "Pad every bucket into arrays once when loading "
+                            "(faster batches, but much more memory) instead "
+                            "of padding each batch from compact buckets.")
+tf.app.flags.DEFINE_boolean("epoch_sampling", True,
+                            "Go through every bucket without replacement, "
+                            "reshuffling it once per epoch; false to sample "
+                            "batches with replacement.")
+tf.app.flags.DEFINE_integer("prefetch_depth", 4,
+                            "Training batches to prepare ahead of model.step "
+                            "in background threads (0: no prefetching).")
+tf.app.flags.DEFINE_integer("prefetch_threads", 1,
+                            "Number of batch prefetching threads.")
+tf.app.flags.DEFINE_string("profile_log", "profile.jsonl",
+                           "JSON-lines file in train_dir that per-step phase "
+                           "times and token throughput are appended to "
+                           "(empty: no log).")
+tf.app.flags.DEFINE_integer("trace_step", 0,
+                            "Write a TF timeline trace of this training step "
+                            "of the run to train_dir (0: no trace).")
+tf.app.flags.DEFINE_string("buckets_file", "",
+                           "JSON bucket layout written by buckets.py; "
+                           "empty to use the built-in _buckets.")
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -79,47 +178,530 @@ FLAGS = tf.app.flags.FLAGS
 #_buckets = [(50, 25), (100, 30), (250, 35), (300, 50)]
 # bucket resizing attept 3
 _buckets = [(100, 25), (200, 30), (300, 35), (400, 35)]
+# or see buckets.py to choose a layout from the data (--buckets_file)
+
+
+class BucketView(object):
+  """Read-only sequence of [source_ids, target_ids] pairs in one bucket.
+
+  The bucket keeps its pairs compactly: the source and target token ids of
+  all of them packed into two flat int32 arrays, with int64 offsets (see
+  bot.batch_sentence_to_token_ids). Only the pairs that are actually indexed
+  are turned into Python lists, so model.get_batch can still sample from a
+  bucket as if it were a list of pairs; pad() builds padded batches straight
+  from the arrays.
+  """
+
+  def __init__(self, source, target):
+    self.source_tokens, self.source_offsets = source
+    self.target_tokens, self.target_offsets = target
+
+  def __len__(self):
+    return len(self.source_offsets) - 1
+
+  def __getitem__(self, index):
+    source_ids = self.source_tokens[
+        self.source_offsets[index]:self.source_offsets[index + 1]].tolist()
+    target_ids = self.target_tokens[
+        self.target_offsets[index]:self.target_offsets[index + 1]].tolist()
+    target_ids.append(bot.EOS_ID)
+    return [source_ids, target_ids]
+
+  def pad(self, rows, encoder_size, decoder_size):
+    """Pads pairs rows the way Seq2SeqModel.get_batch does.
+
+    Returns:
+      encoder and decoder matrices, batch-major: encoder rows are the
+      reversed, padded source; decoder rows are GO, the target (EOS included)
+      and padding.
+    """
+    source, _ = _gather_padded(self.source_tokens, self.source_offsets, rows,
+                               encoder_size)
+    target, lengths = _gather_padded(self.target_tokens, self.target_offsets,
+                                     rows, decoder_size - 1)
+    target[np.arange(len(rows)), lengths] = bot.EOS_ID
+    encoder = source[:, ::-1]
+    decoder = np.hstack([np.full((len(rows), 1), bot.GO_ID, dtype=np.int32),
+                         target])
+    return encoder, decoder
+
+
+def _split_by_bucket(corpus, line_buckets, num_buckets, chunk_lines=1 << 12):
+  """Splits the lines of a packed token-id corpus into one packed corpus per
+  bucket.
+
+  The corpus is read once, in chunks of lines; a memory-mapped one is read
+  through its file, so besides the bucket arrays only one chunk of it is ever
+  in memory.
+
+  Args:
+    corpus: (tokens, offsets) pair, as from bot.load_token_ids.
+    line_buckets: bucket of every line to use, -1 to drop the line.
+    num_buckets: number of buckets.
+  Returns:
+    a list with the (tokens, offsets) pair of every bucket.
+  """
+  tokens, offsets = corpus
+  num_lines = len(line_buckets)
+  offsets = np.asarray(offsets[:num_lines + 1], dtype=np.int64)
+  lengths = np.diff(offsets)
+  buckets_out = []
+  for bucket_id in xrange(num_buckets):
+    bucket_offsets = np.zeros(np.count_nonzero(line_buckets == bucket_id) + 1,
+                              dtype=np.int64)
+    np.cumsum(lengths[line_buckets == bucket_id], out=bucket_offsets[1:])
+    buckets_out.append((np.empty(bucket_offsets[-1], dtype=np.int32),
+                        bucket_offsets))
+  filled = [0] * num_buckets  # lines of each bucket copied so far
+  corpus_file = None
+  if isinstance(tokens, np.memmap):
+    corpus_file = open(tokens.filename, "rb")
+  try:
+    for begin in xrange(0, num_lines, chunk_lines):
+      end = min(begin + chunk_lines, num_lines)
+      first, last = offsets[begin], offsets[end]
+      if corpus_file:
+        corpus_file.seek(tokens.offset + first * tokens.itemsize)
+        chunk = np.fromfile(corpus_file, dtype=tokens.dtype, count=last - first)
+      else:
+        chunk = np.asarray(tokens[first:last])
+      # The bucket of every token of the chunk; lines keep their order.
+      token_buckets = np.repeat(line_buckets[begin:end].astype(np.int16),
+                                lengths[begin:end])
+      for bucket_id, (bucket_tokens, bucket_offsets) in enumerate(buckets_out):
+        mask = token_buckets == bucket_id
+        destination = bucket_offsets[filled[bucket_id]]
+        count = np.count_nonzero(mask)
+        bucket_tokens[destination:destination + count] = chunk[mask]
+        filled[bucket_id] += np.count_nonzero(
+            line_buckets[begin:end] == bucket_id)
+  finally:
+    if corpus_file:
+      corpus_file.close()
+  return buckets_out
 
 
 def read_data(source_path, target_path, max_size=None):
-  """Read data from source and target files and put into buckets.
+  """Read data from source and target corpora and put into buckets.
   Args:
-    source_path: path to the files with token-ids for the source language.
-    target_path: path to the file with token-ids for the target language;
+    source_path: path to the token-id corpus for the source language (binary,
+      or a text .ids file that will be converted, see bot.load_token_ids).
+    target_path: path to the token-id corpus for the target language;
       it must be aligned with the source file: n-th line contains the desired
       output for n-th line from the source_path.
     max_size: maximum number of lines to read, all other will be ignored;
       if 0 or None, data files will be read completely (no limit).
   Returns:
-    data_set: a list of length len(_buckets); data_set[n] contains a list of
-      (source, target) pairs read from the provided data files that fit
+    data_set: a list of length len(_buckets); data_set[n] is a BucketView, a
+      compact sequence of (source, target) pairs from the data files that fit
       into the n-th bucket, i.e., such that len(source) < _buckets[n][0] and
       len(target) < _buckets[n][1]; source and target are lists of token-ids.
   """
   print("sourcepath: "+source_path)
   print("target_path: "+target_path)
 
-  data_set = [[] for _ in _buckets]
-  with tf.gfile.GFile(source_path, mode="r") as source_file:
-    with tf.gfile.GFile(target_path, mode="r") as target_file:
-      source, target = source_file.readline(), target_file.readline()
-      counter = 0
-      while source and target and (not max_size or counter < max_size):
-        counter += 1
-        if counter % 100 == 0:
-          print("  reading data line %d" % counter)
-          sys.stdout.flush()
-        source_ids = [int(x) for x in source.split()]
-        target_ids = [int(x) for x in target.split()]
-        target_ids.append(bot.EOS_ID)
-        for bucket_id, (source_size, target_size) in enumerate(_buckets):
-          if len(source_ids) < source_size and len(target_ids) < target_size:
-          	data_set[bucket_id].append([source_ids, target_ids])
-          	break
-        source, target = source_file.readline(), target_file.readline()
+  source = bot.load_token_ids(source_path)
+  target = bot.load_token_ids(target_path)
+  num_lines = min(len(source[1]), len(target[1])) - 1
+  if max_size:
+    num_lines = min(num_lines, max_size)
+  source_lens = np.diff(source[1][:num_lines + 1])
+  # +1 for the EOS symbol appended to every target.
+  target_lens = np.diff(target[1][:num_lines + 1]) + 1
+
+  line_buckets = np.full(num_lines, -1, dtype=np.int64)
+  for bucket_id in reversed(xrange(len(_buckets))):
+    source_size, target_size = _buckets[bucket_id]
+    line_buckets[(source_lens < source_size) &
+                 (target_lens < target_size)] = bucket_id
+  data_set = [BucketView(source_bucket, target_bucket)
+              for source_bucket, target_bucket in zip(
+                  _split_by_bucket(source, line_buckets, len(_buckets)),
+                  _split_by_bucket(target, line_buckets, len(_buckets)))]
+  print("  read %d lines, %d fit no bucket"
+        % (num_lines, np.count_nonzero(line_buckets < 0)))
+  sys.stdout.flush()
   return data_set
 
 
+def _pad_rows(tokens, starts, lengths, width):
+  """Copies tokens[starts[i]:starts[i] + lengths[i]] into row i of a
+  (len(starts), width) int32 matrix padded with PAD_ID."""
+  padded = np.full((len(starts), width), bot.PAD_ID, dtype=np.int32)
+  mask = np.arange(width) < lengths[:, None]
+  if mask.any():
+    padded[mask] = tokens[(starts[:, None] + np.arange(width))[mask]]
+  return padded
+
+
+def _pad_batch(source, batch_size):
+  """Appends PAD-only rows to a batch of sources up to batch_size rows;
+  Seq2SeqModel.step feeds exactly model.batch_size rows."""
+  if len(source) >= batch_size:
+    return source
+  padding = np.full((batch_size - len(source), source.shape[1]), bot.PAD_ID,
+                    dtype=source.dtype)
+  return np.concatenate([source, padding])
+
+
+def _gather_padded(tokens, offsets, rows, width):
+  """Gathers lines rows of a packed token-id array into a (len(rows), width)
+  int32 matrix padded with PAD_ID; also returns the line lengths."""
+  starts = np.asarray(offsets[rows], dtype=np.int64)
+  lengths = np.asarray(offsets[rows + 1], dtype=np.int64) - starts
+  return _pad_rows(tokens, starts, lengths, width), lengths
+
+
+def _pad_bucket(pairs, encoder_size, decoder_size):
+  """Pads the pairs of one bucket the way Seq2SeqModel.get_batch does.
+
+  Returns:
+    encoder and decoder matrices, batch-major: encoder rows are the reversed,
+    padded source; decoder rows are GO, the target (EOS included) and padding.
+  """
+  if isinstance(pairs, BucketView):
+    return pairs.pad(np.arange(len(pairs)), encoder_size, decoder_size)
+  source = np.full((len(pairs), encoder_size), bot.PAD_ID, dtype=np.int32)
+  target = np.full((len(pairs), decoder_size - 1), bot.PAD_ID, dtype=np.int32)
+  for i, (source_ids, target_ids) in enumerate(pairs):
+    source[i, :len(source_ids)] = source_ids
+    target[i, :len(target_ids)] = target_ids
+  encoder = source[:, ::-1]
+  decoder = np.hstack([np.full((len(pairs), 1), bot.GO_ID, dtype=np.int32),
+                       target])
+  return encoder, decoder
+
+
+def _target_weights(decoder):
+  """Target weights of batch-major decoder inputs: the weight is 0 where the
+  next decoder input (the target) is padding."""
+  weights = np.zeros(decoder.shape, dtype=np.float32)
+  weights[:, :-1] = decoder[:, 1:] != bot.PAD_ID
+  return weights
+
+
+class PaddedBuckets(object):
+  """A bucketed data set padded once into contiguous arrays.
+
+  Each bucket keeps time-major int32 encoder and decoder inputs and float32
+  target weights, exactly as Seq2SeqModel.get_batch would build them, so a
+  batch is just a fancy-indexed set of random columns.
+  """
+
+  def __init__(self, data_set, buckets):
+    self.encoder_inputs, self.decoder_inputs, self.target_weights = [], [], []
+    for bucket_id, (encoder_size, decoder_size) in enumerate(buckets):
+      encoder, decoder = _pad_bucket(data_set[bucket_id], encoder_size,
+                                     decoder_size)
+      weights = _target_weights(decoder)
+      self.encoder_inputs.append(np.ascontiguousarray(encoder.T))
+      self.decoder_inputs.append(np.ascontiguousarray(decoder.T))
+      self.target_weights.append(np.ascontiguousarray(weights.T))
+
+  def bucket_size(self, bucket_id):
+    return self.encoder_inputs[bucket_id].shape[1]
+
+  def get_batch(self, bucket_id, batch_size):
+    """Get a random batch (sampled with replacement) from bucket_id.
+
+    Returns:
+      The triple (encoder_inputs, decoder_inputs, target_weights) in the
+      time-major list-of-arrays format of Seq2SeqModel.get_batch.
+    """
+    rows = np.random.randint(0, self.bucket_size(bucket_id), batch_size)
+    return self.get_rows(bucket_id, rows)
+
+  def get_rows(self, bucket_id, rows):
+    """Get the batch of the given rows (pair indices) of bucket_id."""
+    return (list(self.encoder_inputs[bucket_id][:, rows]),
+            list(self.decoder_inputs[bucket_id][:, rows]),
+            list(self.target_weights[bucket_id][:, rows]))
+
+
+class CompactBuckets(object):
+  """A bucketed data set kept compact and padded one batch at a time.
+
+  Same interface as PaddedBuckets, but a bucket holds only the real tokens of
+  its pairs (see BucketView) instead of every pair padded to the bucket size;
+  get_rows pads just the requested rows with a few vectorized gathers.
+  """
+
+  def __init__(self, data_set, buckets):
+    self.data_set = data_set
+    self.buckets = buckets
+
+  def bucket_size(self, bucket_id):
+    return len(self.data_set[bucket_id])
+
+  def get_batch(self, bucket_id, batch_size):
+    """Get a random batch (sampled with replacement) from bucket_id."""
+    rows = np.random.randint(0, self.bucket_size(bucket_id), batch_size)
+    return self.get_rows(bucket_id, rows)
+
+  def get_rows(self, bucket_id, rows):
+    """Get the batch of the given rows (pair indices) of bucket_id."""
+    encoder_size, decoder_size = self.buckets[bucket_id]
+    encoder, decoder = self.data_set[bucket_id].pad(rows, encoder_size,
+                                                    decoder_size)
+    weights = _target_weights(decoder)
+    return (list(np.ascontiguousarray(encoder.T)),
+            list(np.ascontiguousarray(decoder.T)),
+            list(np.ascontiguousarray(weights.T)))
+
+
+def bucketed_data(data_set, buckets):
+  """The training data set representation chosen by --prepad_buckets."""
+  if FLAGS.prepad_buckets:
+    return PaddedBuckets(data_set, buckets)
+  return CompactBuckets(data_set, buckets)
+
+
+def choose_bucket(buckets_scale):
+  """Choose a bucket according to data distribution. We pick a random number
+  in [0, 1] and use the corresponding interval in buckets_scale."""
+  random_number_01 = np.random.random_sample()
+  return min(bisect.bisect_right(buckets_scale, random_number_01),
+             len(buckets_scale) - 1)
+
+
+class RandomSampler(object):
+  """Samples batches with replacement: a bucket in proportion to its size,
+  then random rows of it."""
+
+  def __init__(self, bucket_sizes, batch_size):
+    total_size = float(sum(bucket_sizes))
+    self.buckets_scale = [sum(bucket_sizes[:i + 1]) / total_size
+                          for i in xrange(len(bucket_sizes))]
+    self.bucket_sizes = bucket_sizes
+    self.batch_size = batch_size
+
+  def sample(self):
+    """Returns the (bucket_id, rows) of the next batch."""
+    bucket_id = choose_bucket(self.buckets_scale)
+    return bucket_id, np.random.randint(0, self.bucket_sizes[bucket_id],
+                                        self.batch_size)
+
+
+class EpochSampler(object):
+  """Samples batches without replacement, one epoch at a time per bucket.
+
+  Every bucket is walked through in a random order that is reshuffled each
+  time the bucket runs out (a batch that crosses the end is completed from
+  the new order). Buckets are still chosen in proportion to their sizes, by
+  bisecting a cumulative table of them, so all buckets finish their epochs at
+  about the same rate. Safe to share between prefetch threads.
+  """
+
+  def __init__(self, bucket_sizes, batch_size, seed=None):
+    self.bucket_sizes = bucket_sizes
+    self.batch_size = batch_size
+    self.cumulative = np.cumsum(bucket_sizes).tolist()
+    self.total_size = self.cumulative[-1]
+    self.rng = np.random.RandomState(seed)
+    self.orders = [self.rng.permutation(size) for size in bucket_sizes]
+    self.positions = [0] * len(bucket_sizes)
+    self.bucket_epochs = [0] * len(bucket_sizes)
+    self.served = 0
+    self.lock = threading.Lock()
+
+  def sample(self):
+    """Returns the (bucket_id, rows) of the next batch."""
+    with self.lock:
+      bucket_id = min(bisect.bisect_right(
+          self.cumulative, self.rng.random_sample() * self.total_size),
+                      len(self.cumulative) - 1)
+      size = self.bucket_sizes[bucket_id]
+      rows = []
+      while len(rows) < self.batch_size:
+        position = self.positions[bucket_id]
+        if position == size:
+          self.orders[bucket_id] = self.rng.permutation(size)
+          self.positions[bucket_id] = position = 0
+          self.bucket_epochs[bucket_id] += 1
+        take = min(size - position, self.batch_size - len(rows))
+        rows.extend(self.orders[bucket_id][position:position + take])
+        self.positions[bucket_id] += take
+      self.served += self.batch_size
+      return bucket_id, np.array(rows)
+
+  @property
+  def epoch(self):
+    """Pairs served so far, in passes over the whole training set."""
+    return self.served / float(self.total_size)
+
+  def stats(self):
+    return ("epoch %.2f (completed per bucket: %s)"
+            % (self.epoch, self.bucket_epochs))
+
+
+class _ProducerError(object):
+  """The exc_info of an error in a BatchPrefetcher producer thread."""
+
+  def __init__(self, exc_info):
+    self.exc_info = exc_info
+
+
+class BatchPrefetcher(object):
+  """Prepares training batches in background threads.
+
+  Producer threads take the next bucket and rows from a sampler (RandomSampler
+  or EpochSampler), build that batch, and put the pair on a bounded queue of
+  the given depth, so the next batches are ready while model.step runs. The
+  consumer side counts how often it had to wait, and the producers total the
+  time they spend sampling and building batches. An error in a producer is
+  handed over the queue and raised again by get().
+  """
+
+  def __init__(self, data_set, sampler, depth, num_threads=1):
+    self.data_set = data_set
+    self.sampler = sampler
+    self.queue = queue.Queue(maxsize=depth)
+    self.stopped = threading.Event()
+    self.lock = threading.Lock()
+    self.reset_stats()
+    self.threads = [threading.Thread(target=self._produce)
+                    for _ in xrange(num_threads)]
+    for thread in self.threads:
+      thread.daemon = True
+      thread.start()
+
+  def _produce(self):
+    try:
+      while not self.stopped.is_set():
+        start_time = time.time()
+        bucket_id, rows = self.sampler.sample()
+        sampled_time = time.time()
+        batch = self.data_set.get_rows(bucket_id, rows)
+        with self.lock:
+          self.sample_time += sampled_time - start_time
+          self.get_batch_time += time.time() - sampled_time
+        self._put((bucket_id, batch))
+    except Exception:  # pylint: disable=broad-except
+      # The training loop would otherwise wait for this thread forever.
+      self._put(_ProducerError(sys.exc_info()))
+
+  def _put(self, item):
+    while not self.stopped.is_set():
+      try:
+        self.queue.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def get(self):
+    """Returns the next (bucket_id, batch) pair, waiting if none is ready.
+
+    Raises the error of a producer thread that failed.
+    """
+    self.batches += 1
+    try:
+      item = self.queue.get_nowait()
+    except queue.Empty:
+      self.waits += 1
+      start_time = time.time()
+      item = self.queue.get()
+      self.wait_time += time.time() - start_time
+    if isinstance(item, _ProducerError):
+      six.reraise(*item.exc_info)
+    return item
+
+  def stats(self):
+    return ("prefetch: waited for %d of %d batches (%.3fs); producers spent "
+            "%.3fs sampling, %.3fs in get_batch"
+            % (self.waits, self.batches, self.wait_time, self.sample_time,
+               self.get_batch_time))
+
+  def phase_times(self):
+    """Returns the producers' sample and get_batch time since the last
+    reset_stats, summed over threads, as phases for the profile log."""
+    with self.lock:
+      return {"prefetch_sample": self.sample_time,
+              "prefetch_get_batch": self.get_batch_time}
+
+  def reset_stats(self):
+    with self.lock:
+      self.batches, self.waits, self.wait_time = 0, 0, 0.0
+      self.sample_time, self.get_batch_time = 0.0, 0.0
+
+  def stop(self):
+    self.stopped.set()
+    for thread in self.threads:
+      thread.join()
+
+
+def vocabulary_paths():
+  """Returns the paths of the (context, user) vocabularies the model in
+  train_dir was trained with."""
+  settings = bot.load_vocab_settings(FLAGS.train_dir)
+  if settings:
+    return settings["context_vocab"], settings["user_vocab"]
+  tag = bot.tokenization_tag(FLAGS.bpe_merges)
+  return (os.path.join(FLAGS.data_dir, "vocab%d%s.context" % (bot.vocab_size, tag)),
+          os.path.join(FLAGS.data_dir, "vocab%d%s.user" % (bot.vocab_size, tag)))
+
+
+def decode_tokenizer():
+  """Returns the tokenizer the model in train_dir was trained with (None:
+  bot.basic_tokenizer)."""
+  if FLAGS.bpe_merges:
+    return bot.bpe_tokenizer(FLAGS.bpe_merges)
+  return None
+
+
+def output_text(output, rev_vocab):
+  """Returns the text of output token ids, with BPE subwords joined back
+  into words."""
+  tokens = [rev_vocab[o] for o in output]
+  if FLAGS.bpe_merges:
+    # a subword may end inside a multi-byte character
+    return bpe.decode(tokens).decode("utf-8", "replace")
+  return " ".join([tf.compat.as_str(t) for t in tokens])
+
+
+def fit_vocabularies(context_paths, user_paths, context_vocab, user_vocab):
+  """Fits both vocabularies to the data (see bot.fit_vocabularies), sets the
+  model's vocabulary sizes and num_samples to match, and records all of it
+  in train_dir so that decoding builds the same model.
+
+  Returns:
+    the remapped context and user corpus paths.
+  """
+  settings = bot.fit_vocabularies(
+      context_vocab, user_vocab, context_paths, user_paths,
+      FLAGS.vocab_coverage, FLAGS.vocab_min_count, FLAGS.num_samples,
+      FLAGS.bpe_merges)
+  bot.save_vocab_settings(FLAGS.train_dir, settings)
+  apply_vocab_settings(settings)
+  return settings["context_corpora"], settings["user_corpora"]
+
+
+def fitted_beforehand(settings):
+  """Whether settings (see bot.fit_vocabularies) record corpora fitted with
+  the current flags, e.g. by sweep.py once for all of its runs."""
+  return (settings is not None and "context_corpora" in settings and
+          settings["vocab_coverage"] == FLAGS.vocab_coverage and
+          settings["vocab_min_count"] == FLAGS.vocab_min_count and
+          settings.get("bpe_merges", 0) == FLAGS.bpe_merges)
+
+
+def apply_vocab_settings(settings):
+  """Sets the vocabulary flags from the settings fit_vocabularies recorded."""
+  FLAGS.en_vocab_size = settings["en_vocab_size"]
+  FLAGS.fr_vocab_size = settings["fr_vocab_size"]
+  FLAGS.num_samples = settings["num_samples"]
+  print("Vocabulary sizes %d (context) and %d (user), %s"
+        % (FLAGS.en_vocab_size, FLAGS.fr_vocab_size,
+           "%d samples" % FLAGS.num_samples if FLAGS.num_samples
+           else "full softmax"))
+
+
+def session_config():
+  """Session options from the --intra_op_threads/--inter_op_threads flags."""
+  return tf.ConfigProto(
+      intra_op_parallelism_threads=FLAGS.intra_op_threads,
+      inter_op_parallelism_threads=FLAGS.inter_op_threads)
+
+
 def create_model(session, forward_only):
   """Create translation model and initialize or load parameters in session."""
   dtype = tf.float16 if FLAGS.use_fp16 else tf.float32
@@ -133,28 +715,155 @@ def create_model(session, forward_only):
       FLAGS.batch_size,
       FLAGS.learning_rate,
       FLAGS.learning_rate_decay_factor,
+      num_samples=FLAGS.num_samples,
       forward_only=forward_only)
       #dtype=dtype)
   ckpt = tf.train.get_checkpoint_state(FLAGS.train_dir)
   if ckpt and tf.gfile.Exists(ckpt.model_checkpoint_path):
     print("Reading model parameters from %s" % ckpt.model_checkpoint_path)
+    # Taken before restoring, so a checkpoint rewritten meanwhile reloads.
+    model.checkpoint_identity = checkpoint_identity(ckpt.model_checkpoint_path)
     model.saver.restore(session, ckpt.model_checkpoint_path)
+    model.checkpoint_path = ckpt.model_checkpoint_path
   else:
     print("Created model with fresh parameters.")
     session.run(tf.initialize_all_variables())
+    model.checkpoint_path = None
+    model.checkpoint_identity = None
   return model
 
 
+class _TracedSession(object):
+  """Forwards run() to a session, recording a full trace of the call."""
+
+  def __init__(self, session):
+    self.session = session
+    self.options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    self.run_metadata = tf.RunMetadata()
+
+  def run(self, fetches, feed_dict=None):
+    return self.session.run(fetches, feed_dict, options=self.options,
+                            run_metadata=self.run_metadata)
+
+
+def traced_step(sess, model, trace_path, *step_args):
+  """model.step, also writing its Chrome timeline trace to trace_path."""
+  traced = _TracedSession(sess)
+  outputs = model.step(traced, *step_args)
+  trace = timeline.Timeline(traced.run_metadata.step_stats)
+  with tf.gfile.GFile(trace_path, mode="w") as trace_file:
+    trace_file.write(trace.generate_chrome_trace_format())
+  print("wrote timeline trace to %s" % trace_path)
+  return outputs
+
+
+class AsyncCheckpointer(object):
+  """Writes checkpoints from a snapshot of the variables in a background thread.
+
+  save() copies the current values of the variables out of the training
+  session with one session.run and returns. A writer thread loads them into a
+  mirror graph with the same variable names and saves that, so the files can
+  be restored with model.saver. A save that is still being written when the
+  next one is requested is waited for first. The mirror graph holds a second
+  copy of the variables.
+  """
+
+  def __init__(self, session, variables, max_to_keep=5):
+    self.session = session
+    self.variables = variables
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      self.placeholders, assigns, mirrors = [], [], {}
+      for v in variables:
+        dtype = v.dtype.base_dtype
+        mirror = tf.Variable(tf.zeros(v.get_shape(), dtype=dtype),
+                             trainable=False)
+        placeholder = tf.placeholder(dtype, v.get_shape())
+        self.placeholders.append(placeholder)
+        assigns.append(mirror.assign(placeholder))
+        mirrors[v.op.name] = mirror
+      self.assign_op = tf.group(*assigns)
+      self.saver = tf.train.Saver(mirrors, max_to_keep=max_to_keep)
+      init = tf.initialize_all_variables()
+    self.mirror_session = tf.Session(graph=self.graph)
+    self.mirror_session.run(init)
+    self.thread = None
+    self.write_time = 0.0
+
+  def save(self, checkpoint_path, global_step):
+    """Snapshots the variables and starts writing them to checkpoint_path."""
+    self.wait()
+    values = self.session.run(self.variables)
+    # Not a daemon, so an interrupted run still finishes its last checkpoint.
+    self.thread = threading.Thread(target=self._write,
+                                   args=(values, checkpoint_path, global_step))
+    self.thread.start()
+
+  def _write(self, values, checkpoint_path, global_step):
+    start_time = time.time()
+    self.mirror_session.run(self.assign_op,
+                            dict(zip(self.placeholders, values)))
+    self.saver.save(self.mirror_session, checkpoint_path,
+                    global_step=global_step)
+    self.write_time = time.time() - start_time
+
+  def wait(self):
+    """Waits for the checkpoint being written, if any."""
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+
+
+def evaluate(sess, model, dev_set):
+  """Runs a dev batch through every bucket and prints its perplexity.
+
+  Returns:
+    the perplexity of every bucket, None for empty ones.
+  """
+  eval_perplexities = []
+  for bucket_id in xrange(len(_buckets)):
+    if dev_set.bucket_size(bucket_id) == 0:
+      print("  eval: empty bucket %d" % (bucket_id))
+      eval_perplexities.append(None)
+      continue
+    encoder_inputs, decoder_inputs, target_weights = dev_set.get_batch(
+        bucket_id, FLAGS.batch_size)
+    _, eval_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
+                                 target_weights, bucket_id, True)
+    eval_ppx = math.exp(float(eval_loss)) if eval_loss < 300 else float(
+        "inf")
+    print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
+    eval_perplexities.append(eval_ppx)
+  return eval_perplexities
+
+
 def train():
   """Train a en->fr translation model using WMT data."""
   # Prepare WMT data.
   print("Preparing WMT data in %s" % FLAGS.data_dir)
   #en_train, fr_train, en_dev, fr_dev, _, _ = download_and_prepare()
-  user_train, context_train, context_dev, user_dev, _, _ = bot.download_and_prepare()
+  if FLAGS.prepare_data:
+    (user_train, context_train, context_dev, user_dev, context_vocab,
+     user_vocab) = bot.download_and_prepare(FLAGS.bpe_merges)
+  else:
+    (user_train, context_train, context_dev, user_dev, context_vocab,
+     user_vocab) = bot.prepared_paths(FLAGS.bpe_merges)
+  settings = bot.load_vocab_settings(FLAGS.train_dir)
+  if not FLAGS.prepare_data and fitted_beforehand(settings):
+    # Use the recorded corpora as they are: fitting again here would rewrite
+    # files that other runs on the same prepared data are reading.
+    context_train, context_dev = settings["context_corpora"]
+    user_train, user_dev = settings["user_corpora"]
+  # Subword vocabularies are small enough to size the model to them as they
+  # are (fitting with coverage and min_count 0 keeps every entry).
+  elif FLAGS.vocab_coverage or FLAGS.vocab_min_count or FLAGS.bpe_merges:
+    (context_train, context_dev), (user_train, user_dev) = fit_vocabularies(
+        [context_train, context_dev], [user_train, user_dev],
+        context_vocab, user_vocab)
 
   print("returned")
 
-  with tf.Session() as sess:
+  with tf.Session(config=session_config()) as sess:
     # Create model.
     print("Creating %d layers of %d units." % (FLAGS.num_layers, FLAGS.size))
     model = create_model(sess, False)
@@ -162,82 +871,158 @@ def train():
     # Read data into buckets and compute their sizes.
     print ("Reading development and training data (limit: %d)."
            % FLAGS.max_train_data_size)
-    dev_set = read_data(context_dev, user_dev)
-    train_set = read_data(context_train, user_train, FLAGS.max_train_data_size)
-    train_bucket_sizes = [len(train_set[b]) for b in xrange(len(_buckets))]
+    steps_per_eval = (FLAGS.steps_per_checkpoint if FLAGS.steps_per_eval < 0
+                      else FLAGS.steps_per_eval)
+    dev_set = None
+    if steps_per_eval > 0:
+      dev_set = bucketed_data(read_data(context_dev, user_dev), _buckets)
+    train_set = bucketed_data(
+        read_data(context_train, user_train, FLAGS.max_train_data_size),
+        _buckets)
+    train_bucket_sizes = [train_set.bucket_size(b) for b in xrange(len(_buckets))]
     train_total_size = float(sum(train_bucket_sizes))
-
-    # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
-    # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
-    # the size if i-th training bucket, as used later.
     print(train_total_size)
-    train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
-                           for i in xrange(len(train_bucket_sizes))]
+
+    # Both samplers pick a bucket with probability proportional to its size.
+    if FLAGS.epoch_sampling:
+      sampler = EpochSampler(train_bucket_sizes, FLAGS.batch_size)
+    else:
+      sampler = RandomSampler(train_bucket_sizes, FLAGS.batch_size)
+
+    prefetcher = None
+    if FLAGS.prefetch_depth > 0:
+      prefetcher = BatchPrefetcher(train_set, sampler, FLAGS.prefetch_depth,
+                                   FLAGS.prefetch_threads)
+
+    profiler = train_profiler.StepProfiler(
+        os.path.join(FLAGS.train_dir, FLAGS.profile_log)
+        if FLAGS.profile_log else None, len(_buckets))
+
+    checkpointer = None
+    if FLAGS.async_checkpoint:
+      checkpointer = AsyncCheckpointer(sess, tf.all_variables())
 
     # This is the training loop.
-    step_time, loss = 0.0, 0.0
-    current_step = 0
+    step_time, batch_time, loss = 0.0, 0.0, 0.0
+    current_step, checkpoint_step = 0, 0
     previous_losses = []
+    train_start = time.time()
     while True:
-      # Choose a bucket according to data distribution. We pick a random number
-      # in [0, 1] and use the corresponding interval in train_buckets_scale.
-      random_number_01 = np.random.random_sample()
-      bucket_id = min([i for i in xrange(len(train_buckets_scale))
-                       if train_buckets_scale[i] > random_number_01])
-
       # Get a batch and make a step.
       start_time = time.time()
-      encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-          train_set, bucket_id)
-      _, step_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
-                                   target_weights, bucket_id, False)
+      if prefetcher:
+        with profiler.phase("batch_wait"):
+          bucket_id, (encoder_inputs, decoder_inputs,
+                      target_weights) = prefetcher.get()
+      else:
+        with profiler.phase("sample"):
+          bucket_id, rows = sampler.sample()
+        with profiler.phase("get_batch"):
+          encoder_inputs, decoder_inputs, target_weights = train_set.get_rows(
+              bucket_id, rows)
+      batch_time += (time.time() - start_time) / FLAGS.steps_per_checkpoint
+      step_args = (encoder_inputs, decoder_inputs, target_weights, bucket_id,
+                   False)
+      with profiler.phase("model_step"):
+        if current_step + 1 == FLAGS.trace_step:
+          trace_path = os.path.join(FLAGS.train_dir,
+                                    "timeline_step%d.json" % FLAGS.trace_step)
+          _, step_loss, _ = traced_step(sess, model, trace_path, *step_args)
+        else:
+          _, step_loss, _ = model.step(sess, *step_args)
       step_time += (time.time() - start_time) / FLAGS.steps_per_checkpoint
       loss += step_loss / FLAGS.steps_per_checkpoint
       current_step += 1
+      profiler.end_step(bucket_id, encoder_inputs, target_weights)
 
-      # Once in a while, we save checkpoint, print statistics, and run evals.
-      if current_step % FLAGS.steps_per_checkpoint == 0:
+      at_budget = ((FLAGS.max_steps and current_step >= FLAGS.max_steps) or
+                   (FLAGS.max_seconds and
+                    time.time() - train_start >= FLAGS.max_seconds))
+
+      # Once in a while, we save checkpoint and print statistics.
+      if current_step % FLAGS.steps_per_checkpoint == 0 or at_budget:
+        # The sums above are per steps_per_checkpoint steps; rescale them
+        # when the budget ends the run in the middle of an interval.
+        scale = FLAGS.steps_per_checkpoint / (current_step - checkpoint_step)
+        step_time, batch_time, loss = (step_time * scale, batch_time * scale,
+                                       loss * scale)
+        checkpoint_step = current_step
         # Print statistics for the previous epoch.
         perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
-        print ("global step %d learning rate %.4f step-time %.2f perplexity "
-               "%.2f" % (model.global_step.eval(), model.learning_rate.eval(),
-                         step_time, perplexity))
+        print ("global step %d learning rate %.4f step-time %.2f (batch %.4f, "
+               "model.step %.2f) perplexity %.2f" % (
+                   model.global_step.eval(), model.learning_rate.eval(),
+                   step_time, batch_time, step_time - batch_time, perplexity))
+        if FLAGS.epoch_sampling:
+          print("  " + sampler.stats())
+        # Sampling and get_batch run in the producer threads when
+        # prefetching; their totals go into the checkpoint entry.
+        prefetch_times = prefetcher.phase_times() if prefetcher else {}
+        if prefetcher:
+          print("  " + prefetcher.stats())
+          prefetcher.reset_stats()
         # Decrease learning rate if no improvement was seen over last 3 times.
         if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
           sess.run(model.learning_rate_decay_op)
         previous_losses.append(loss)
         # Save checkpoint and zero timer and loss.
         checkpoint_path = os.path.join(FLAGS.train_dir, "translate.ckpt")
-        model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-        step_time, loss = 0.0, 0.0
-        # Run evals on development set and print their perplexity.
-        for bucket_id in xrange(len(_buckets)):
-          if len(dev_set[bucket_id]) == 0:
-            print("  eval: empty bucket %d" % (bucket_id))
-            continue
-          encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-              dev_set, bucket_id)
-          _, eval_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
-                                       target_weights, bucket_id, True)
-          eval_ppx = math.exp(float(eval_loss)) if eval_loss < 300 else float(
-              "inf")
-          print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
+        with profiler.phase("save"):
+          if checkpointer:
+            checkpointer.save(checkpoint_path, int(model.global_step.eval()))
+          else:
+            model.saver.save(sess, checkpoint_path,
+                             global_step=model.global_step)
+        step_time, batch_time, loss = 0.0, 0.0, 0.0
+        extra = dict(prefetch_times)
+        if FLAGS.epoch_sampling:
+          extra["epoch"] = sampler.epoch
+        if checkpointer:
+          # Time the previous checkpoint took to write in the background.
+          extra["background_save"] = checkpointer.write_time
+        entry = profiler.end_checkpoint(int(model.global_step.eval()),
+                                        perplexity=perplexity, **extra)
+        print(train_profiler.report(entry))
+        sys.stdout.flush()
+
+      # Run evals on development set and print their perplexity.
+      if steps_per_eval > 0 and (current_step % steps_per_eval == 0 or
+                                 at_budget):
+        # Timed on its own: eval runs on its own schedule, so as a profiler
+        # phase its time would land in the next step's accounting.
+        eval_start = time.time()
+        eval_perplexities = evaluate(sess, model, dev_set)
+        eval_time = time.time() - eval_start
+        print("  eval: %.2fs" % eval_time)
+        profiler.event("eval", global_step=int(model.global_step.eval()),
+                       seconds=eval_time, eval_perplexities=eval_perplexities)
         sys.stdout.flush()
 
+      if at_budget:
+        print("stopping after %d steps in %.0fs"
+              % (current_step, time.time() - train_start))
+        break
+
+    if checkpointer:
+      checkpointer.wait()
+    if prefetcher:
+      prefetcher.stop()
+    profiler.close()
+
 
 def decode():
-  with tf.Session() as sess:
+  with tf.Session(config=session_config()) as sess:
     # Create model and load parameters.
-    model = create_model(sess, True)
-    model.batch_size = 1  # We decode one sentence at a time.
+    # Beam search feeds its own decoder inputs (see beam_search).
+    model = create_model(sess, FLAGS.beam_width <= 1)
+    model.batch_size = FLAGS.beam_width  # We decode one sentence at a time.
+    cache = create_decode_cache(model)
 
-    # Load vocabularies.
-    user_vocab_path = os.path.join(FLAGS.data_dir,
-                                 "vocab%d.user" % bot.vocab_size)
-    context_vocab_path = os.path.join(FLAGS.data_dir,
-                                 "vocab%d.context" % bot.vocab_size)
-    user_vocab, _ = bot.initialize_vocabulary(user_vocab_path)
-    _, rev_context_vocab = bot.initialize_vocabulary(context_vocab_path)
+    # Contexts are the model's source side, user tweets its target side.
+    context_vocab_path, user_vocab_path = vocabulary_paths()
+    context_vocab, _ = bot.load_vocabulary(context_vocab_path)
+    _, rev_user_vocab = bot.load_vocabulary(user_vocab_path)
+    tokenizer = decode_tokenizer()
 
     # Decode from standard input.
     sys.stdout.write("> ")
@@ -245,37 +1030,358 @@ def decode():
     sentence = sys.stdin.readline()
     while sentence:
       # Get token-ids for the input sentence.
-      token_ids = bot.sentence_to_token_ids(tf.compat.as_bytes(sentence), user_vocab)
-      # Which bucket does it belong to?
-      bucket_id = len(_buckets) - 1
-      for i, bucket in enumerate(_buckets):
-        if bucket[0] >= len(token_ids):
-          bucket_id = i
-          break
-      else:
-        logging.warning("Sentence truncated: %s", sentence)
-
-      # Get a 1-element batch to feed the sentence to the model.
-      encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-          {bucket_id: [(token_ids, [])]}, bucket_id)
-      # Get output logits for the sentence.
-      _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
-                                       target_weights, bucket_id, True)
-      # This is a greedy decoder - outputs are just argmaxes of output_logits.
-      outputs = [int(np.argmax(logit, axis=1)) for logit in output_logits]
-      # If there is an EOS symbol in outputs, cut them at that point.
-      if bot.EOS_ID in outputs:
-        outputs = outputs[:outputs.index(bot.EOS_ID)]
-      # Print out French sentence corresponding to outputs.
-      print(" ".join([tf.compat.as_str(rev_context_vocab[output]) for output in outputs]))
+      token_ids = bot.sentence_to_token_ids(tf.compat.as_bytes(sentence),
+                                            context_vocab, tokenizer)
+      # Pick up new checkpoints; never answer them from the old cache.
+      reload_if_newer(sess, model, cache)
+      outputs = decode_batches(
+          sess, model, np.array(token_ids, dtype=np.int32),
+          np.array([0, len(token_ids)]), FLAGS.beam_width,
+          FLAGS.length_penalty, cache)[0]
+      # Print out the tweet corresponding to outputs.
+      print(output_text(outputs, rev_user_vocab))
       print("> ", end="")
       sys.stdout.flush()
       sentence = sys.stdin.readline()
+    if cache is not None:
+      print(cache.stats())
+
+
+def _greedy_decode(sess, model, bucket_id, source):
+  """Greedy outputs for a batch of padded sources of one bucket."""
+  encoder_size, decoder_size = _buckets[bucket_id]
+  encoder_inputs = list(np.ascontiguousarray(source[:, ::-1].T))
+  decoder_inputs = [np.full(len(source), bot.GO_ID, dtype=np.int32)] + [
+      np.full(len(source), bot.PAD_ID, dtype=np.int32)
+      for _ in xrange(decoder_size - 1)]
+  target_weights = [np.zeros(len(source), dtype=np.float32)
+                    for _ in xrange(decoder_size)]
+  _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
+                                   target_weights, bucket_id, True)
+  # This is a greedy decoder - outputs are just argmaxes of output_logits.
+  return np.array([np.argmax(logit, axis=1) for logit in output_logits]).T
+
+
+def _output_projection(sess):
+  """Returns the (w, b) arrays of the model's output projection, or None.
+
+  Seq2SeqModel only projects its outputs to the vocabulary in the graph when
+  it is built forward-only, so beam search does it itself.
+  """
+  variables = dict((v.op.name, v) for v in tf.all_variables())
+  if "proj_w" not in variables:
+    return None
+  return sess.run([variables["proj_w"], variables["proj_b"]])
+
+
+def beam_search(sess, model, bucket_id, source, beam_width,
+                length_penalty=0.6, projection=None):
+  """Beam search for a batch of padded sources of one bucket.
+
+  All beams of all sources run as one batch of len(source) * beam_width rows.
+  The model must be built with forward_only=False, so that it is fed our
+  decoder inputs (the beam prefixes) instead of its own greedy outputs. Every
+  decoder position costs one full model.step, which re-runs the encoder and
+  the whole unrolled decoder for beam_width rows per source, so a batch of
+  sources costs up to decoder_size steps where greedy decoding takes one.
+  Running the encoder once and stepping only the decoder would need a one-step
+  decoder graph over the model's variables, fed the cached attention states
+  and cell state; the legacy Seq2SeqModel does not expose them, and that is
+  not done here. The beam state lives in NumPy arrays and the best beam_width
+  extensions of each source are picked with argpartition over beam_width *
+  vocabulary candidates. Finished hypotheses are ranked by log-probability /
+  ((5 + length) / 6) ** length_penalty.
+
+  Args:
+    sess, model: session and model built with forward_only=False.
+    bucket_id: bucket of the sources.
+    source: (num, encoder_size) int32 sources, padded but not reversed.
+    beam_width: number of hypotheses kept per source.
+    length_penalty: length normalization exponent (0: none).
+    projection: output projection from _output_projection, if any.
+  Returns:
+    a (num, decoder_size) int matrix with the best output of every source.
+  """
+  encoder_size, decoder_size = _buckets[bucket_id]
+  num = len(source)
+  rows = np.arange(num)[:, None] * beam_width
+  encoder = np.repeat(source[:, ::-1], beam_width, axis=0)
+  encoder_inputs = list(np.ascontiguousarray(encoder.T))
+  target_weights = [np.zeros(num * beam_width, dtype=np.float32)
+                    for _ in xrange(decoder_size)]
+  decoder = np.full((num * beam_width, decoder_size), bot.PAD_ID, dtype=np.int32)
+  decoder[:, 0] = bot.GO_ID
+  outputs = np.full((num * beam_width, decoder_size), bot.EOS_ID, dtype=np.int32)
+  # Start from a single live hypothesis per source.
+  scores = np.full((num, beam_width), -np.inf)
+  scores[:, 0] = 0.0
+  finished = np.zeros((num, beam_width), dtype=bool)
+  lengths = np.zeros((num, beam_width), dtype=np.int64)
+  for t in xrange(decoder_size):
+    _, _, output_logits = model.step(
+        sess, encoder_inputs, list(np.ascontiguousarray(decoder.T)),
+        target_weights, bucket_id, True)
+    logits = output_logits[t]
+    if projection is not None:
+      logits = np.dot(logits, projection[0]) + projection[1]
+    logits = logits - logits.max(axis=1, keepdims=True)
+    log_probs = logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+    log_probs = log_probs.reshape(num, beam_width, -1)
+    vocab_size = log_probs.shape[2]
+    # Finished hypotheses only continue, unchanged, through EOS.
+    log_probs[finished] = -np.inf
+    log_probs[finished, bot.EOS_ID] = 0.0
+    candidates = (scores[:, :, None] + log_probs).reshape(num, -1)
+    top = np.argpartition(-candidates, beam_width - 1, axis=1)[:, :beam_width]
+    top_scores = np.take_along_axis(candidates, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    scores = np.take_along_axis(top_scores, order, axis=1)
+    parents, tokens = top // vocab_size, top % vocab_size
+    finished = np.take_along_axis(finished, parents, axis=1)
+    lengths = np.take_along_axis(lengths, parents, axis=1)
+    lengths += ~finished & (tokens != bot.EOS_ID)
+    finished |= tokens == bot.EOS_ID
+    parent_rows = (rows + parents).ravel()
+    decoder = decoder[parent_rows]
+    outputs = outputs[parent_rows]
+    outputs[:, t] = tokens.ravel()
+    if t + 1 < decoder_size:
+      decoder[:, t + 1] = tokens.ravel()
+    if finished.all():
+      break
+  penalty = ((5.0 + lengths) / 6.0) ** length_penalty
+  best = np.argmax(scores / penalty, axis=1)
+  return outputs[rows.ravel() + best]
+
+
+def decode_batches(sess, model, token_ids, offsets, beam_width=1,
+                   length_penalty=0.6, cache=None):
+  """Decodes many token-id sequences, a full batch per model.step.
+
+  Sequences are grouped by bucket (longer than the largest bucket: its last
+  tokens are kept, as with get_batch) and fed in batches of model.batch_size
+  rows; with beam search every source takes beam_width of those rows. The
+  last batch of a bucket is padded with PAD-only rows, whose outputs are
+  dropped.
+
+  Args:
+    sess, model: session and model; forward-only for greedy decoding, built
+      with forward_only=False for beam search.
+    token_ids, offsets: packed sequences, as from
+      bot.batch_sentence_to_token_ids.
+    beam_width: 1 for greedy decoding, otherwise the beam width; must divide
+      model.batch_size.
+    length_penalty: length normalization exponent for beam search.
+    cache: optional decode_cache.DecodeCache, already set to the checkpoint of
+      the model; only inputs it misses are decoded, each distinct one once.
+  Returns:
+    a list with the output token ids of every sequence, in input order.
+  Raises:
+    ValueError: if beam_width does not divide model.batch_size.
+  """
+  starts = np.asarray(offsets[:-1], dtype=np.int64)
+  lengths = np.diff(offsets)
+  encoder_sizes = np.array([b[0] for b in _buckets])
+  bucket_ids = np.minimum(np.searchsorted(encoder_sizes, lengths),
+                          len(_buckets) - 1)
+  if model.batch_size % beam_width:
+    raise ValueError("batch size %d is not a multiple of beam width %d"
+                     % (model.batch_size, beam_width))
+  batch_size = model.batch_size // beam_width
+  projection = _output_projection(sess) if beam_width > 1 else None
+  outputs = [None] * len(lengths)
+  needed = np.ones(len(lengths), dtype=bool)
+  if cache is not None:
+    # Key every input by what the model sees: bucket and kept token ids.
+    kept = np.minimum(lengths, encoder_sizes[bucket_ids])
+    keys = [decode_cache.decode_key(
+        bucket_ids[row], token_ids[starts[row] + lengths[row] - kept[row]:
+                                   starts[row] + lengths[row]].tolist(),
+        beam_width, length_penalty) for row in xrange(len(lengths))]
+    first_row = {}
+    for row, key in enumerate(keys):
+      if key in first_row:
+        needed[row] = False
+        continue
+      first_row[key] = row
+      outputs[row] = cache.get(key)
+      needed[row] = outputs[row] is None
+  for bucket_id, (encoder_size, decoder_size) in enumerate(_buckets):
+    rows = np.flatnonzero((bucket_ids == bucket_id) & needed)
+    if len(rows) > 0 and lengths[rows].max() > encoder_size:
+      logging.warning("%d sentences truncated to %d tokens",
+                      (lengths[rows] > encoder_size).sum(), encoder_size)
+    for begin in xrange(0, len(rows), batch_size):
+      batch = rows[begin:begin + batch_size]
+      batch_lengths = np.minimum(lengths[batch], encoder_size)
+      batch_starts = starts[batch] + lengths[batch] - batch_lengths
+      source = _pad_rows(token_ids, batch_starts, batch_lengths, encoder_size)
+      # The last batch of a bucket is filled up with dummy rows.
+      source = _pad_batch(source, batch_size)
+      if beam_width > 1:
+        best = beam_search(sess, model, bucket_id, source, beam_width,
+                           length_penalty, projection)
+      else:
+        best = _greedy_decode(sess, model, bucket_id, source)
+      for row, output in zip(batch, best[:len(batch)].tolist()):
+        # If there is an EOS symbol in outputs, cut them at that point.
+        if bot.EOS_ID in output:
+          output = output[:output.index(bot.EOS_ID)]
+        outputs[row] = output
+        if cache is not None:
+          cache.put(keys[row], output)
+  if cache is not None:
+    # Repeats of an input within this call; not counted as cache lookups.
+    for row, key in enumerate(keys):
+      if outputs[row] is None:
+        outputs[row] = outputs[first_row[key]]
+  return outputs
+
+
+def decode_sequences(sess, model, sequences, beam_width=1,
+                     length_penalty=0.6, cache=None):
+  """Decodes a list of token-id lists (a served micro-batch) with
+  decode_batches, which pads it to model.batch_size rows."""
+  offsets = np.cumsum([0] + [len(s) for s in sequences])
+  token_ids = np.concatenate([np.asarray(s, dtype=np.int32) for s in sequences])
+  return decode_batches(sess, model, token_ids, offsets, beam_width,
+                        length_penalty, cache)
+
+
+def latest_checkpoint():
+  """Returns the path of the checkpoint create_model loads, or None."""
+  ckpt = tf.train.get_checkpoint_state(FLAGS.train_dir)
+  if ckpt and tf.gfile.Exists(ckpt.model_checkpoint_path):
+    return ckpt.model_checkpoint_path
+  return None
+
+
+def checkpoint_identity(checkpoint):
+  """Returns the path of a checkpoint with its modification time, or None.
+
+  Retraining into the same train_dir writes new parameters under the same
+  checkpoint names, so the path alone does not identify them.
+  """
+  if checkpoint is None:
+    return None
+  return "%s@%r" % (checkpoint, os.path.getmtime(checkpoint))
+
+
+def reload_if_newer(session, model, cache=None):
+  """Restores the latest checkpoint into model if it is not the one model was
+  loaded from, and moves cache over to it (dropping the old results)."""
+  checkpoint = latest_checkpoint()
+  if checkpoint is None:
+    return False
+  identity = checkpoint_identity(checkpoint)
+  if identity == model.checkpoint_identity:
+    return False
+  print("Reading model parameters from %s" % checkpoint)
+  model.saver.restore(session, checkpoint)
+  model.checkpoint_path = checkpoint
+  model.checkpoint_identity = identity
+  if cache is not None:
+    cache.set_checkpoint(identity)
+  return True
+
+
+def create_decode_cache(model):
+  """Returns a DecodeCache for the checkpoint model was loaded from, as set
+  up by the --decode_cache_* flags, or None if caching is off or the model has
+  fresh parameters (they decode differently every run)."""
+  if model.checkpoint_identity is None or (FLAGS.decode_cache_size <= 0 and
+                                           not FLAGS.decode_cache_file):
+    return None
+  cache = decode_cache.DecodeCache(FLAGS.decode_cache_size,
+                                   FLAGS.decode_cache_file or None)
+  cache.set_checkpoint(model.checkpoint_identity)
+  return cache
+
+
+def batch_decode():
+  """Decode every context in FLAGS.decode_input into a tweet, in batches."""
+  with tf.Session(config=session_config()) as sess:
+    # Beam search feeds its own decoder inputs (see beam_search).
+    model = create_model(sess, FLAGS.beam_width <= 1)
+    model.batch_size = FLAGS.batch_size
+    cache = create_decode_cache(model)
+
+    # Contexts are the model's source side, user tweets its target side.
+    context_vocab_path, user_vocab_path = vocabulary_paths()
+    context_vocab, _ = bot.load_vocabulary(context_vocab_path)
+    _, rev_user_vocab = bot.load_vocabulary(user_vocab_path)
+
+    with tf.gfile.GFile(FLAGS.decode_input, mode="rb") as input_file:
+      sentences = input_file.readlines()
+    start_time = time.time()
+    token_ids, offsets = bot.batch_sentence_to_token_ids(sentences,
+                                                         context_vocab,
+                                                         decode_tokenizer())
+    outputs = decode_batches(sess, model, token_ids, offsets,
+                             FLAGS.beam_width, FLAGS.length_penalty, cache)
+    elapsed = time.time() - start_time
+    if cache is not None:
+      print(cache.stats())
+
+    output_path = FLAGS.decode_output or FLAGS.decode_input + ".out"
+    with tf.gfile.GFile(output_path, mode="w") as output_file:
+      for output in outputs:
+        output_file.write(output_text(output, rev_user_vocab) + "\n")
+    print("decoded %d sentences in %.2fs (%.1f sentences/s) to %s"
+          % (len(outputs), elapsed, len(outputs) / max(elapsed, 1e-9),
+             output_path))
+
+
+def serve():
+  """Serve decoding over HTTP, batching concurrent requests per bucket."""
+  with tf.Session(config=session_config()) as sess:
+    # Beam search feeds its own decoder inputs (see beam_search).
+    model = create_model(sess, FLAGS.beam_width <= 1)
+    model.batch_size = FLAGS.batch_size
+    cache = create_decode_cache(model)
+
+    context_vocab_path, user_vocab_path = vocabulary_paths()
+    context_vocab, _ = bot.load_vocabulary(context_vocab_path)
+    _, rev_user_vocab = bot.load_vocabulary(user_vocab_path)
+    tokenizer = decode_tokenizer()
+    encoder_sizes = np.array([b[0] for b in _buckets])
+
+    def bucket_of(length):
+      return min(int(np.searchsorted(encoder_sizes, length)),
+                 len(_buckets) - 1)
+
+    def encode(lines):
+      token_ids, offsets = bot.batch_sentence_to_token_ids(lines,
+                                                           context_vocab,
+                                                           tokenizer)
+      return [token_ids[offsets[i]:offsets[i + 1]]
+              for i in xrange(len(offsets) - 1)]
+
+    def to_text(output):
+      return output_text(output, rev_user_vocab)
+
+    def decode_fn(sequences):
+      # Runs on the batcher's executor thread, the only one using the session.
+      reload_if_newer(sess, model, cache)
+      return decode_sequences(sess, model, sequences, FLAGS.beam_width,
+                              FLAGS.length_penalty, cache)
+
+    batcher = decode_server.MicroBatcher(
+        decode_fn, bucket_of, FLAGS.batch_size // FLAGS.beam_width,
+        FLAGS.max_wait_ms / 1000.0)
+    try:
+      decode_server.serve(batcher, encode, to_text, FLAGS.serve_host,
+                          FLAGS.serve_port, FLAGS.request_timeout)
+    finally:
+      print(batcher.stats.report())
+      if cache is not None:
+        print(cache.stats())
 
 
 def self_test():
   """Test the translation model."""
-  with tf.Session() as sess:
+  with tf.Session(config=session_config()) as sess:
     print("Self-test for neural translation model.")
     # Create model with vocabularies of 10, 2 small buckets, 2 layers of 32.
     model = seq2seq_model.Seq2SeqModel(10, 10, [(3, 3), (6, 6)], 32, 2,
@@ -294,8 +1400,29 @@ def self_test():
 
 
 def main(_):
+  global _buckets
+  settings = bot.load_vocab_settings(FLAGS.train_dir)
+  if settings:
+    # The model in train_dir was built for fitted vocabularies.
+    apply_vocab_settings(settings)
+    if not FLAGS.vocab_coverage and not FLAGS.vocab_min_count:
+      FLAGS.vocab_coverage = settings["vocab_coverage"]
+      FLAGS.vocab_min_count = settings["vocab_min_count"]
+    if not FLAGS.bpe_merges:
+      FLAGS.bpe_merges = settings.get("bpe_merges", 0)
+  if FLAGS.buckets_file:
+    _buckets = buckets.load_buckets(FLAGS.buckets_file)
+    print("Using buckets %s from %s" % (_buckets, FLAGS.buckets_file))
+  if ((FLAGS.serve or FLAGS.decode and FLAGS.decode_input) and
+      FLAGS.batch_size % FLAGS.beam_width):
+    raise ValueError("--batch_size %d is not a multiple of --beam_width %d"
+                     % (FLAGS.batch_size, FLAGS.beam_width))
   if FLAGS.self_test:
     self_test()
+  elif FLAGS.serve:
+    serve()
+  elif FLAGS.decode and FLAGS.decode_input:
+    batch_decode()
   elif FLAGS.decode:
     decode()
   else:
@@ -0,0 +1,110 @@
+"""Content-addressed manifest of the data preparation stages.
+
+Each stage of download_and_prepare is identified by a key: a hash of the
+contents of its inputs, its parameters and the code that implements it. The
+manifest remembers the key every stage's outputs were last built with, so a
+stage is skipped only while its key is unchanged and its outputs are still
+the ones it wrote.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import inspect
+import json
+import os
+
+
+def hash_values(*values):
+    """ Returns a hex digest of the repr of values (strings, numbers, keys) """
+    h = hashlib.sha1()
+    for v in values:
+        h.update(repr(v).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def hash_file(path, block_size=1 << 20):
+    """ Returns a hex digest of the contents of the file at path """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        block = f.read(block_size)
+        while block:
+            h.update(block)
+            block = f.read(block_size)
+    return h.hexdigest()
+
+
+def hash_function(*functions):
+    """ Returns a hex digest of the source code of functions, so that a stage
+        is rebuilt when the code producing it changes
+    """
+    return hash_values(*[inspect.getsource(f) for f in functions])
+
+
+def hash_tweets(sources):
+    """ Returns a hex digest of the id, creation time and text of every tweet
+        in a list of sources (lists of tweets or TweetColumns, as passed to
+        group_by_date)
+    """
+    h = hashlib.sha1()
+    for source in sources:
+        h.update(b"\1")
+        if hasattr(source, "buffer"):
+            # TweetColumns: hash its columns directly
+            for column in (source.ids, source.epochs, source.offsets):
+                h.update(column.tobytes())
+            h.update(source.buffer)
+            continue
+        for t in source:
+            h.update(("%d %s %s\0" % (t.id, t.created_at, t.text)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+class StageCache(object):
+    """ JSON manifest mapping stage name to the key it was built with and the
+        size and mtime of the outputs it wrote
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.stages = json.load(f)
+
+    def is_fresh(self, stage, key, outputs):
+        """ Returns True if stage was last built with key and all of its
+            outputs still exist unmodified
+        """
+        entry = self.stages.get(stage)
+        if entry is None or entry["key"] != key:
+            return False
+        for path in outputs:
+            if not os.path.exists(path) or entry["outputs"].get(path) != _stat(path):
+                return False
+        return True
+
+    def invalidate(self, stage, outputs):
+        """ Forgets stage and deletes its outputs, so builders that skip
+            existing files run again
+        """
+        self.stages.pop(stage, None)
+        for path in outputs:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def record(self, stage, key, outputs):
+        """ Records that stage was built with key and wrote outputs """
+        self.stages[stage] = {"key": key,
+                              "outputs": dict((p, _stat(p)) for p in outputs)}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.stages, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
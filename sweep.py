@@ -0,0 +1,264 @@
+"""Parallel training sweep over graph.py configurations.
+
+Prepares the data once (fitting the vocabularies too, when --vocab_coverage
+or --vocab_min_count is among the graph.py arguments or BPE is on), then
+trains every combination of the given model sizes, layer counts, batch sizes
+and bucket layouts as its own graph.py process, --parallel of them at a time,
+each in a fresh train dir. The processes read the same prepared corpora
+(memory-mapped, read-only); each one is pinned to its own share of the CPUs
+with matching TensorFlow thread settings and stops at a step or time budget.
+At the end one table compares perplexity against wall time and steps per
+second. Arguments after -- are passed on to every graph.py process.
+
+    python sweep.py --size 256 512 --num_layers 2 3 --parallel 4 \\
+        --max_seconds 1800 --sweep_dir sweeps/layers -- --learning_rate 0.3
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import bot
+
+
+def sweep_configs(sizes, num_layers, batch_sizes, buckets_files):
+    """ Returns every combination of the swept values as a list of dicts of
+        graph.py flags
+    """
+    return [{"size": size, "num_layers": layers, "batch_size": batch_size,
+             "buckets_file": buckets_file}
+            for size, layers, batch_size, buckets_file
+            in itertools.product(sizes, num_layers, batch_sizes, buckets_files)]
+
+
+def config_name(config):
+    """ Returns a short name of a config, used for its train dir
+
+        The bucket layout is named by its file's base name and a hash of its
+        full path, so layouts from different directories with the same file
+        name get train dirs of their own.
+    """
+    buckets_file = config["buckets_file"]
+    if buckets_file:
+        buckets = "%s-%s" % (
+            os.path.splitext(os.path.basename(buckets_file))[0],
+            hashlib.sha1(os.path.abspath(buckets_file).encode("utf-8")
+                         ).hexdigest()[:8])
+    else:
+        buckets = "default"
+    return "size%d_layers%d_batch%d_%s" % (config["size"], config["num_layers"],
+                                           config["batch_size"], buckets)
+
+
+def cpu_slices(num_slots):
+    """ Splits the CPUs this process may run on into num_slots disjoint
+        lists of CPU ids
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(multiprocessing.cpu_count()))
+    num_slots = max(1, min(num_slots, len(cpus)))
+    return [s.tolist() for s in np.array_split(cpus, num_slots)]
+
+
+def fitting_args(extra_args):
+    """ Returns the vocabulary fitting flags among the graph.py arguments,
+        with graph.py's defaults
+    """
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--vocab_coverage", type=float, default=0.0)
+    parser.add_argument("--vocab_min_count", type=int, default=0)
+    parser.add_argument("--num_samples", type=int, default=512)
+    return parser.parse_known_args(extra_args)[0]
+
+
+def launch(config, cpus, train_dir, args, extra_args, vocab_settings=None):
+    """ Starts a graph.py training process for config pinned to cpus
+
+        Inputs:
+            dictionary -- vocab_settings -- vocabularies fitted beforehand
+                (see bot.fit_vocabularies), recorded in train_dir so that
+                the process uses them instead of fitting its own
+        Returns:
+            subprocess.Popen -- the process, with its output in train_dir
+    """
+    if not os.path.exists(train_dir):
+        os.makedirs(train_dir)
+    if vocab_settings:
+        bot.save_vocab_settings(train_dir, vocab_settings)
+    command = [sys.executable, "graph.py",
+               "--train_dir", train_dir,
+               "--size", str(config["size"]),
+               "--num_layers", str(config["num_layers"]),
+               "--batch_size", str(config["batch_size"]),
+               "--prepare_data=false",
+               "--max_steps", str(args.max_steps),
+               "--max_seconds", str(args.max_seconds),
+               "--intra_op_threads", str(len(cpus)),
+               "--inter_op_threads", str(args.inter_op_threads),
+               "--bpe_merges", str(args.bpe_merges)]
+    if config["buckets_file"]:
+        command += ["--buckets_file", config["buckets_file"]]
+    command += extra_args
+
+    def pin():
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+
+    log = open(os.path.join(train_dir, "train.log"), "w")
+    process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT,
+                               preexec_fn=pin)
+    log.close()
+    return process
+
+
+def read_results(train_dir, profile_log="profile.jsonl"):
+    """ Summarizes the profile log (see train_profiler) of a finished run
+
+        Returns:
+            dictionary -- steps, train_seconds (time in the training loop),
+                perplexity (training, at the last checkpoint) and
+                dev_perplexity (mean over buckets at the last eval), None
+                where the log has no value
+    """
+    results = {"steps": 0, "train_seconds": 0.0, "perplexity": None,
+               "dev_perplexity": None}
+    path = os.path.join(train_dir, profile_log)
+    if not os.path.exists(path):
+        return results
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry["event"] == "step":
+                results["steps"] += 1
+            elif entry["event"] == "checkpoint":
+                results["train_seconds"] += entry["seconds"]
+                results["perplexity"] = entry.get("perplexity")
+            elif entry["event"] == "eval":
+                perplexities = [p for p in entry["eval_perplexities"]
+                                if p is not None]
+                if perplexities:
+                    results["dev_perplexity"] = float(np.mean(perplexities))
+    return results
+
+
+def comparison_table(rows):
+    """ Returns the sweep results as a text table, best dev (else training)
+        perplexity first
+    """
+    def key(row):
+        ppx = row["dev_perplexity"] if row["dev_perplexity"] is not None \
+            else row["perplexity"]
+        return float("inf") if ppx is None else ppx
+
+    def fmt(value):
+        return "-" if value is None else "%.2f" % value
+
+    lines = ["%-40s %4s %8s %8s %8s %9s %9s" % (
+        "config", "rc", "steps", "wall s", "steps/s", "train ppx", "dev ppx")]
+    for row in sorted(rows, key=key):
+        lines.append("%-40s %4d %8d %8.0f %8.2f %9s %9s" % (
+            row["name"], row["returncode"], row["steps"], row["wall_seconds"],
+            row["steps"] / max(row["train_seconds"], 1e-9),
+            fmt(row["perplexity"]), fmt(row["dev_perplexity"])))
+    return "\n".join(lines)
+
+
+def main():
+    argv = sys.argv[1:]
+    extra_args = []
+    if "--" in argv:
+        extra_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", type=int, nargs="+", default=[1024])
+    parser.add_argument("--num_layers", type=int, nargs="+", default=[3])
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[64])
+    parser.add_argument("--buckets_file", nargs="+", default=[""],
+                        help="bucket layouts from buckets.py ('' for the "
+                             "built-in one)")
+    parser.add_argument("--parallel", type=int, default=2,
+                        help="training processes to run at once")
+    parser.add_argument("--max_steps", type=int, default=0)
+    parser.add_argument("--max_seconds", type=float, default=0.0)
+    parser.add_argument("--inter_op_threads", type=int, default=2)
+    parser.add_argument("--bpe_merges", type=int, default=0,
+                        help="BPE subword merges for every run (0: whole "
+                             "words)")
+    parser.add_argument("--sweep_dir", default="sweep")
+    args = parser.parse_args(argv)
+    if not args.max_steps and not args.max_seconds:
+        parser.error("set --max_steps or --max_seconds, training never ends")
+
+    pending = sweep_configs(args.size, args.num_layers, args.batch_size,
+                            args.buckets_file)
+    names = [config_name(c) for c in pending]
+    if len(set(names)) < len(names):
+        parser.error("some configs are given more than once")
+    # a reused train dir would restore its old checkpoint and append to its
+    # old profile log
+    used = [d for d in [os.path.join(args.sweep_dir, config_name(c))
+                        for c in pending]
+            if os.path.isdir(d) and os.listdir(d)]
+    if used:
+        parser.error("train dirs %s are not empty; remove them or choose "
+                     "another --sweep_dir" % ", ".join(used))
+
+    # prepare (and fit) once; the runs are started with --prepare_data=false
+    # and only read the results
+    (user_train, context_train, context_dev, user_dev, context_vocab,
+     user_vocab) = bot.download_and_prepare(args.bpe_merges)
+    vocab_settings = None
+    fitting = fitting_args(extra_args)
+    if fitting.vocab_coverage or fitting.vocab_min_count or args.bpe_merges:
+        vocab_settings = bot.fit_vocabularies(
+            context_vocab, user_vocab, [context_train, context_dev],
+            [user_train, user_dev], fitting.vocab_coverage,
+            fitting.vocab_min_count, fitting.num_samples, args.bpe_merges)
+    free = cpu_slices(min(args.parallel, len(pending)))
+    running, rows = [], []
+    print("running %d configs, %d at a time on CPUs %s"
+          % (len(pending), len(free), free))
+    while pending or running:
+        while pending and free:
+            config, cpus = pending.pop(0), free.pop(0)
+            name = config_name(config)
+            train_dir = os.path.join(args.sweep_dir, name)
+            process = launch(config, cpus, train_dir, args, extra_args,
+                             vocab_settings)
+            running.append((process, name, train_dir, cpus, time.time()))
+            print("started %s on CPUs %s" % (name, cpus))
+        time.sleep(1)
+        for run in list(running):
+            process, name, train_dir, cpus, start = run
+            if process.poll() is None:
+                continue
+            running.remove(run)
+            free.append(cpus)
+            row = read_results(train_dir)
+            row.update(name=name, returncode=process.returncode,
+                       wall_seconds=time.time() - start)
+            rows.append(row)
+            print("finished %s (exit code %d) in %.0fs"
+                  % (name, process.returncode, row["wall_seconds"]))
+
+    table = comparison_table(rows)
+    print(table)
+    with open(os.path.join(args.sweep_dir, "comparison.txt"), "w") as f:
+        f.write(table + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Local stub of the Twitter timeline API, for tests without network access.
+
+StubTimelineAPI answers user_timeline the way Twitter does (newest first, at
+most count tweets with since_id < id <= max_id) from in-memory timelines, logs
+every call and can be told to fail: a RateLimitError on chosen calls, or any
+exception on the pages of an account that match a condition.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import datetime
+import threading
+
+import tweepy
+
+
+class StubStatus(object):
+    """ The id, created_at and text of a Status object """
+
+    def __init__(self, id, created_at, text):
+        self.id = id
+        self.created_at = created_at
+        self.text = text
+
+
+def make_timeline(account, first_id, count, start=None):
+    """ Returns count tweets of account with ids first_id.., one a minute,
+        newest first
+    """
+    start = start or datetime.datetime(2016, 12, 1)
+    return [StubStatus(i, start + datetime.timedelta(minutes=i - first_id),
+                       u"tweet %d of %s" % (i, account))
+            for i in reversed(range(first_id, first_id + count))]
+
+
+class StubTimelineAPI(object):
+    """ tweepy.API stand-in serving in-memory timelines
+
+        Inputs:
+            dictionary (account : list of StubStatus) -- timelines -- newest
+                first
+    """
+
+    def __init__(self, timelines):
+        self.timelines = dict(timelines)
+        self.calls = []  # (account, kwargs) of every user_timeline call
+        self.rate_limited_calls = set()  # call numbers that raise RateLimitError
+        self.failures = {}  # account -> (condition on kwargs, exception)
+        self.lock = threading.Lock()
+
+    def post(self, account, tweets):
+        """ Adds tweets (newest first) to the top of account's timeline """
+        self.timelines[account] = list(tweets) + self.timelines.get(account, [])
+
+    def fail(self, account, exception, when=lambda kwargs: True):
+        """ Makes the pages of account whose kwargs satisfy when raise
+            exception
+        """
+        self.failures[account] = (when, exception)
+
+    def user_timeline(self, account, count=20, since_id=None, max_id=None):
+        kwargs = {"count": count, "since_id": since_id, "max_id": max_id}
+        with self.lock:
+            self.calls.append((account, kwargs))
+            call = len(self.calls)
+        if call in self.rate_limited_calls:
+            raise tweepy.RateLimitError("Rate limit exceeded")
+        if account in self.failures:
+            when, exception = self.failures[account]
+            if when(kwargs):
+                raise exception
+        page = [t for t in self.timelines.get(account, [])
+                if (since_id is None or t.id > since_id) and
+                (max_id is None or t.id <= max_id)]
+        return page[:count]
+
+    def pages(self, account):
+        """ Returns the number of user_timeline calls made for account """
+        return sum(1 for a, _ in self.calls if a == account)
@@ -0,0 +1,118 @@
+"""Tests of graph.decode_batches against a stand-in for Seq2SeqModel.step."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import decode_cache
+
+try:
+    import bot
+    import graph
+except ImportError:  # TensorFlow is not installed
+    graph = None
+
+BUCKETS = [(3, 3), (6, 6)]
+
+
+class FakeSeq2SeqModel(object):
+    """ Seq2SeqModel stand-in whose step, like the real one, only takes
+        exactly batch_size rows; every output is the first source token, then
+        EOS
+    """
+
+    def __init__(self, batch_size, vocab_size=20):
+        self.batch_size = batch_size
+        self.vocab_size = vocab_size
+        self.steps = 0
+
+    def step(self, session, encoder_inputs, decoder_inputs, target_weights,
+             bucket_id, forward_only):
+        self.steps += 1
+        for inputs in (encoder_inputs, decoder_inputs, target_weights):
+            for column in inputs:
+                if len(column) != self.batch_size:
+                    raise ValueError("fed %d rows to a model of batch size %d"
+                                     % (len(column), self.batch_size))
+        # sources are fed reversed: the last encoder input is the first token
+        first = np.asarray(encoder_inputs[-1])
+        rows = np.arange(self.batch_size)
+        output_logits = []
+        for t in range(len(decoder_inputs)):
+            logits = np.zeros((self.batch_size, self.vocab_size), dtype=np.float32)
+            logits[rows, first if t == 0 else bot.EOS_ID] = 5.0
+            output_logits.append(logits)
+        return None, None, output_logits
+
+
+def pack(sequences):
+    token_ids = np.array([t for s in sequences for t in s], dtype=np.int32)
+    offsets = np.cumsum([0] + [len(s) for s in sequences])
+    return token_ids, offsets
+
+
+@unittest.skipIf(graph is None, "needs TensorFlow")
+class DecodeBatchesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.buckets, graph._buckets = graph._buckets, BUCKETS
+        # 4 sources in the first bucket and 3 in the second
+        self.sequences = [[4, 5], [6], [7, 8, 9], [10, 11, 12, 13], [14, 15],
+                          [16, 17, 18, 19, 4], [5, 6, 7, 8]]
+
+    def tearDown(self):
+        graph._buckets = self.buckets
+
+    def test_greedy_pads_short_batches(self):
+        model = FakeSeq2SeqModel(batch_size=3)
+        token_ids, offsets = pack(self.sequences)
+        outputs = graph.decode_batches(None, model, token_ids, offsets)
+        self.assertEqual(outputs, [[s[0]] for s in self.sequences])
+        self.assertEqual(model.steps, 3)
+
+    def test_beam_search_pads_short_batches(self):
+        model = FakeSeq2SeqModel(batch_size=4)
+        token_ids, offsets = pack(self.sequences)
+        outputs = graph.decode_batches(None, model, token_ids, offsets,
+                                       beam_width=2)
+        self.assertEqual(outputs, [[s[0]] for s in self.sequences])
+
+    def test_beam_width_must_divide_batch_size(self):
+        token_ids, offsets = pack(self.sequences)
+        with self.assertRaises(ValueError):
+            graph.decode_batches(None, FakeSeq2SeqModel(batch_size=5),
+                                 token_ids, offsets, beam_width=2)
+
+    def test_repeated_inputs_are_looked_up_once(self):
+        cache = decode_cache.DecodeCache()
+        cache.set_checkpoint("checkpoint")
+        sequences = [[4, 5], [6], [4, 5], [4, 5]]
+        token_ids, offsets = pack(sequences)
+        model = FakeSeq2SeqModel(batch_size=3)
+        outputs = graph.decode_batches(None, model, token_ids, offsets,
+                                       cache=cache)
+        self.assertEqual(outputs, [[4], [6], [4], [4]])
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        graph.decode_batches(None, model, token_ids, offsets, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_rewritten_checkpoint_has_a_new_identity(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "translate.ckpt-200")
+        with open(path, "wb") as f:
+            f.write(b"first run")
+        identity = graph.checkpoint_identity(path)
+        os.utime(path, (1, 1))
+        self.assertNotEqual(graph.checkpoint_identity(path), identity)
+        self.assertIsNone(graph.checkpoint_identity(None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+"""Tests of decode_server over HTTP on a local port."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+import json
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+import decode_server
+from tests.test_decode_batches import BUCKETS, FakeSeq2SeqModel, graph
+
+
+def encode(lines):
+    return [[int(token) for token in line.split()] for line in lines]
+
+
+def to_text(output):
+    return " ".join(str(token) for token in output)
+
+
+class ServerThread(threading.Thread):
+    """ Runs a DecodeServer on an ephemeral port until stop() """
+
+    def __init__(self, batcher, request_timeout=60.0):
+        super(ServerThread, self).__init__()
+        self.server = decode_server.DecodeServer(batcher, encode, to_text,
+                                                 request_timeout)
+        self.started = threading.Event()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        _, self.port = self.loop.run_until_complete(
+            self.server.start("127.0.0.1", 0))
+        self.started.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(self.server.close())
+        self.loop.close()
+
+    def __enter__(self):
+        self.start()
+        self.started.wait(10)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join(10)
+
+    def request(self, path, body=None):
+        """ Returns the status and body of a GET (or POST of body) """
+        url = "http://127.0.0.1:%d%s" % (self.port, path)
+        try:
+            response = urllib.request.urlopen(url, body, timeout=10)
+            return response.status, response.read().decode("utf-8")
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode("utf-8")
+
+
+def concurrently(function, num_calls):
+    """ Returns the results of num_calls concurrent calls of function(i) """
+    results = [None] * num_calls
+
+    def call(i):
+        results[i] = function(i)
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(num_calls)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+class DecodeServerTest(unittest.TestCase):
+
+    @unittest.skipIf(graph is None, "needs TensorFlow")
+    def test_serves_short_micro_batches_to_a_fixed_batch_model(self):
+        buckets, graph._buckets = graph._buckets, BUCKETS
+        self.addCleanup(setattr, graph, "_buckets", buckets)
+        model = FakeSeq2SeqModel(batch_size=8)
+        batcher = decode_server.MicroBatcher(
+            lambda sequences: graph.decode_sequences(None, model, sequences),
+            lambda length: 0 if length <= 3 else 1, model.batch_size, 0.005)
+        with ServerThread(batcher) as server:
+            replies = concurrently(
+                lambda i: server.request("/", b"%d 5\n%d 6 7 8\n" % (i + 4, i + 5)),
+                12)
+            status, stats = server.request("/stats")
+        self.assertEqual(replies,
+                         [(200, "%d\n%d\n" % (i + 4, i + 5)) for i in range(12)])
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(stats)["sequences"], 24)
+
+    def test_stop_fails_pending_requests(self):
+        def slow_decode(sequences):
+            time.sleep(0.5)
+            return sequences
+        batcher = decode_server.MicroBatcher(slow_decode, lambda length: 0, 1, 0.0)
+        server = ServerThread(batcher).__enter__()
+        replies = []
+        clients = [threading.Thread(target=lambda: replies.append(
+            server.request("/", b"1 2\n"))) for _ in range(3)]
+        for client in clients:
+            client.start()
+        time.sleep(0.2)
+        server.stop()
+        for client in clients:
+            client.join(10)
+        self.assertEqual(sorted(replies),
+                         [(503, "the decoding server stopped")] * 3)
+
+    def test_request_timeout(self):
+        def slow_decode(sequences):
+            time.sleep(0.5)
+            return sequences
+        batcher = decode_server.MicroBatcher(slow_decode, lambda length: 0, 1, 0.0)
+        with ServerThread(batcher, request_timeout=0.1) as server:
+            self.assertEqual(server.request("/", b"1 2\n"),
+                             (503, "decoding timed out"))
+
+
+if __name__ == "__main__":
+    unittest.main()
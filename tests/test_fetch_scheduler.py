@@ -0,0 +1,173 @@
+"""Tests of fetch_scheduler against the local stub timeline service."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import tweepy
+
+import fetch_scheduler
+import tweet_store
+from tests.stub_timeline import StubTimelineAPI, make_timeline
+
+
+def _ids(tweets):
+    return [t.id for t in tweets]
+
+
+class FetchTimelinesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timelines = {"a": make_timeline("a", 1000, 450),
+                          "b": make_timeline("b", 5000, 250),
+                          "c": make_timeline("c", 9000, 30)}
+        self.api = StubTimelineAPI(self.timelines)
+        self.accounts = ["a", "b", "c"]
+
+    def test_fetches_every_tweet(self):
+        fetched, stats = fetch_scheduler.fetch_timelines(self.api, self.accounts)
+        for account in self.accounts:
+            self.assertEqual(_ids(fetched[account]), _ids(self.timelines[account]))
+        self.assertEqual(stats["failed"], [])
+        # full pages plus the empty one that ends every timeline
+        self.assertEqual(stats["pages"], 4 + 3 + 2)
+        self.assertGreater(stats["pages_per_second"], 0)
+
+    def test_since_id_fetches_only_newer_tweets(self):
+        since_ids = {"a": self.timelines["a"][10].id}
+        fetched, _ = fetch_scheduler.fetch_timelines(self.api, ["a"], since_ids)
+        self.assertEqual(_ids(fetched["a"]), _ids(self.timelines["a"][:10]))
+        self.assertEqual(self.api.pages("a"), 2)
+
+    def test_interleaves_accounts(self):
+        fetch_scheduler.fetch_timelines(self.api, self.accounts, num_workers=1)
+        accounts = [account for account, _ in self.api.calls]
+        # one page of every account before the second page of any
+        self.assertEqual(accounts[:3], ["a", "b", "c"])
+        self.assertEqual(accounts[3:6], ["a", "b", "c"])
+
+    def test_budget_exhaustion_waits_for_reset(self):
+        budget = fetch_scheduler.RateLimitBudget(self.api, limit=5, window=0.2)
+        fetched, stats = fetch_scheduler.fetch_timelines(
+            self.api, self.accounts, budget=budget, num_workers=2)
+        self.assertGreater(budget.waited, 0)
+        self.assertEqual(stats["failed"], [])
+        for account in self.accounts:
+            self.assertEqual(_ids(fetched[account]), _ids(self.timelines[account]))
+
+    def test_rate_limit_error_is_retried(self):
+        self.api.rate_limited_calls = set([1, 2])
+        budget = fetch_scheduler.RateLimitBudget(self.api, window=0.2)
+        fetched, stats = fetch_scheduler.fetch_timelines(
+            self.api, self.accounts, budget=budget, num_workers=1)
+        # the API said the budget is used up, so the scheduler waited
+        self.assertGreater(budget.waited, 0)
+        self.assertEqual(stats["failed"], [])
+        self.assertEqual(len(self.api.calls), 2 + 4 + 3 + 2)
+        for account in self.accounts:
+            self.assertEqual(_ids(fetched[account]), _ids(self.timelines[account]))
+
+    def test_failing_account_is_given_up(self):
+        self.api.fail("b", tweepy.TweepError("Internal error"))
+        fetched, stats = fetch_scheduler.fetch_timelines(
+            self.api, self.accounts, max_failures=3)
+        self.assertEqual(stats["failed"], ["b"])
+        self.assertEqual(self.api.pages("b"), 3)
+        self.assertEqual(_ids(fetched["a"]), _ids(self.timelines["a"]))
+        self.assertEqual(_ids(fetched["c"]), _ids(self.timelines["c"]))
+
+    def test_unexpected_exceptions_do_not_hang(self):
+        self.api.fail("b", ValueError("bad reply"))
+        result = []
+        thread = threading.Thread(target=lambda: result.append(
+            fetch_scheduler.fetch_timelines(self.api, self.accounts)))
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), "fetch_timelines hung")
+        fetched, stats = result[0]
+        self.assertEqual(stats["failed"], ["b"])
+        self.assertEqual(_ids(fetched["a"]), _ids(self.timelines["a"]))
+
+
+class UpdateAccountsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = tweet_store.TweetStore(os.path.join(self.dir, "tweets.db"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_failed_account_is_not_stored(self):
+        api = StubTimelineAPI({"a": make_timeline("a", 1, 1000),
+                               "b": make_timeline("b", 1, 10)})
+        fetch_scheduler.update_accounts(self.store, ["a", "b"], api)
+        self.assertEqual(len(self.store.tweets("a")), 1000)
+        newest = self.store.max_id("a")
+
+        # 600 new tweets, but every page below the newest one fails
+        api.post("a", make_timeline("a", 1001, 600))
+        api.fail("a", tweepy.TweepError("Over capacity"),
+                 when=lambda kwargs: kwargs["max_id"] is not None)
+        stats = fetch_scheduler.update_accounts(self.store, ["a", "b"], api)
+        self.assertEqual(stats["failed"], ["a"])
+        self.assertEqual(self.store.max_id("a"), newest)
+        self.assertEqual(len(self.store.tweets("a")), 1000)
+
+        # the next clean run picks up all of them
+        del api.failures["a"]
+        stats = fetch_scheduler.update_accounts(self.store, ["a", "b"], api)
+        self.assertEqual(stats["failed"], [])
+        self.assertEqual(_ids(self.store.tweets("a")), list(range(1600, 0, -1)))
+
+
+class StaleStatusAPI(object):
+    """ rate_limit_status that reports a used-up budget whose reset time has
+        already passed, the first used_up times it is asked
+    """
+
+    def __init__(self, used_up):
+        self.used_up = used_up
+        self.status_calls = 0
+
+    def rate_limit_status(self):
+        self.status_calls += 1
+        remaining = 0 if self.status_calls <= self.used_up else 5
+        endpoint = {"remaining": remaining, "reset": time.time() - 60}
+        return {"resources": {"statuses": {
+            fetch_scheduler.TIMELINE_ENDPOINT: endpoint}}}
+
+
+class RateLimitBudgetTest(unittest.TestCase):
+
+    def test_past_reset_time_still_waits(self):
+        api = StaleStatusAPI(used_up=2)
+        budget = fetch_scheduler.RateLimitBudget(api)
+        start = time.time()
+        budget.acquire(fetch_scheduler.TIMELINE_ENDPOINT)
+        self.assertGreaterEqual(time.time() - start,
+                                2 * fetch_scheduler.MIN_WAIT - 0.05)
+        self.assertEqual(api.status_calls, 3)
+
+    def test_sleeps_without_holding_the_lock(self):
+        budget = fetch_scheduler.RateLimitBudget(StaleStatusAPI(used_up=1))
+        waiter = threading.Thread(target=budget.acquire,
+                                  args=(fetch_scheduler.TIMELINE_ENDPOINT,))
+        waiter.start()
+        time.sleep(0.1)
+        acquired = budget.lock.acquire(timeout=0.5)
+        if acquired:
+            budget.lock.release()
+        waiter.join(10)
+        self.assertTrue(acquired)
+
+
+if __name__ == "__main__":
+    unittest.main()
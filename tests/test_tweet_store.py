@@ -0,0 +1,65 @@
+"""Tests of tweet_store, fed through a stub user_timeline with no network."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import fetch_scheduler
+import tweet_store
+from tests.stub_timeline import StubStatus, StubTimelineAPI, make_timeline
+
+
+class TweetStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = tweet_store.TweetStore(os.path.join(self.dir, "tweets.db"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_add_ignores_stored_tweets(self):
+        self.assertIsNone(self.store.max_id(1))
+        tweets = make_timeline(1, 100, 5)
+        self.assertEqual(self.store.add(1, tweets[2:]), 3)
+        self.assertEqual(self.store.add(1, tweets), 2)
+        self.assertEqual(self.store.max_id(1), 104)
+        self.assertIsNone(self.store.max_id(2))
+
+    def test_tweets_round_trip_newest_first(self):
+        created = datetime.datetime(2016, 12, 19, 8, 30, 5)
+        tweets = [StubStatus(7, created, u"caf\xe9 \u2014 news"),
+                  StubStatus(9, created + datetime.timedelta(hours=1), u"later")]
+        self.store.add(3, tweets)
+        columns = self.store.tweets(3)
+        self.assertEqual([t.id for t in columns], [9, 7])
+        self.assertEqual(columns[1].text, u"caf\xe9 \u2014 news")
+        self.assertEqual(columns[1].created_at, created)
+        self.assertEqual(columns.texts(), [u"later", u"caf\xe9 \u2014 news"])
+
+    def test_incremental_update_fetches_only_new_pages(self):
+        api = StubTimelineAPI({1: make_timeline(1, 1, 3000),
+                               2: make_timeline(2, 1, 40)})
+        fetch_scheduler.update_accounts(self.store, [1, 2], api)
+        # 15 full pages and the empty one that ends the timeline
+        self.assertEqual(api.pages(1), 16)
+        self.assertEqual(len(self.store.tweets(1)), 3000)
+
+        # a day later: one page of new tweets and the empty page after it
+        api.calls = []
+        api.post(1, make_timeline(1, 3001, 150))
+        fetch_scheduler.update_accounts(self.store, [1, 2], api)
+        self.assertEqual(api.pages(1), 2)
+        self.assertEqual(api.calls[0][1]["since_id"], 3000)
+        self.assertEqual(api.pages(2), 1)
+        self.assertEqual([t.id for t in self.store.tweets(1)],
+                         list(range(3150, 0, -1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+"""Per-step timing and throughput log of the training loop.
+
+graph.train times every phase of a step (bucket sampling, get_batch or the
+wait for a prefetched batch, model_step), the checkpoint save and every dev
+eval, counts the real and padded tokens of every batch, and appends all of it
+as JSON lines to the train dir. With prefetching, sampling and get_batch run
+in the producer threads; the checkpoint entry then has their totals over the
+interval as prefetch_sample and prefetch_get_batch:
+
+    {"event": "step", "step": 17, "bucket": 2, "get_batch": 0.0004, ...}
+    {"event": "checkpoint", "global_step": 200, "save": 1.9,
+     "buckets": [{"bucket": 0, "real_tokens_per_second": ..., ...}], ...}
+    {"event": "eval", "global_step": 200, "seconds": 0.8,
+     "eval_perplexities": [...]}
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+import bot
+
+
+def batch_tokens(encoder_inputs, target_weights):
+    """ Returns the real (non-padding) and padded token counts of a batch in
+        the time-major format of Seq2SeqModel.get_batch; targets are counted
+        by their weights, which are 0 exactly on padding
+    """
+    encoder = np.asarray(encoder_inputs)
+    weights = np.asarray(target_weights)
+    real = int(np.count_nonzero(encoder != bot.PAD_ID)) + int(weights.sum())
+    return real, encoder.size + weights.size
+
+
+class StepProfiler(object):
+    """ Accumulates phase times and token counts and writes them as JSON lines
+
+        Inputs:
+            string -- path -- JSON-lines file to append to; None to only keep
+                the totals printed by the training loop
+            int -- num_buckets -- number of buckets
+    """
+
+    def __init__(self, path, num_buckets):
+        self.log = open(path, "a") if path else None
+        self.num_buckets = num_buckets
+        self.steps = 0
+        self.current = {}
+        self.reset()
+
+    def reset(self):
+        """ Starts a new checkpoint interval """
+        self.start = time.time()
+        self.totals = collections.defaultdict(float)
+        self.bucket_steps = [0] * self.num_buckets
+        self.bucket_time = [0.0] * self.num_buckets
+        self.real_tokens = [0] * self.num_buckets
+        self.padded_tokens = [0] * self.num_buckets
+
+    @contextmanager
+    def phase(self, name):
+        """ Times the enclosed block as phase name of the current step (or of
+            the checkpoint, for save)
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start_time
+            self.current[name] = self.current.get(name, 0.0) + elapsed
+            self.totals[name] += elapsed
+
+    def end_step(self, bucket_id, encoder_inputs, target_weights):
+        """ Ends a training step on bucket_id and logs its phase times """
+        real, padded = batch_tokens(encoder_inputs, target_weights)
+        self.steps += 1
+        self.bucket_steps[bucket_id] += 1
+        self.bucket_time[bucket_id] += sum(self.current.values())
+        self.real_tokens[bucket_id] += real
+        self.padded_tokens[bucket_id] += padded
+        self._write(dict(self.current, event="step", step=self.steps,
+                         bucket=bucket_id, real_tokens=real,
+                         padded_tokens=padded))
+        self.current = {}
+
+    def end_checkpoint(self, global_step, **values):
+        """ Logs the totals of the interval since the last checkpoint (plus
+            any extra values, e.g. perplexities) and starts a new one
+
+            Returns:
+                dictionary -- the logged entry
+        """
+        buckets = []
+        for b in range(self.num_buckets):
+            seconds = max(self.bucket_time[b], 1e-9)
+            buckets.append({"bucket": b,
+                            "steps": self.bucket_steps[b],
+                            "real_tokens_per_second": self.real_tokens[b] / seconds,
+                            "padded_tokens_per_second": self.padded_tokens[b] / seconds})
+        elapsed = max(time.time() - self.start, 1e-9)
+        entry = dict(self.totals, **values)
+        entry.update(event="checkpoint", global_step=global_step,
+                     seconds=elapsed, buckets=buckets,
+                     real_tokens_per_second=sum(self.real_tokens) / elapsed,
+                     padded_tokens_per_second=sum(self.padded_tokens) / elapsed)
+        self.current = {}
+        self._write(entry)
+        if self.log:
+            self.log.flush()
+        self.reset()
+        return entry
+
+    def event(self, name, **values):
+        """ Logs a JSON line for an event outside the step and checkpoint
+            cycle (e.g. a dev eval on its own schedule)
+        """
+        self._write(dict(values, event=name))
+
+    def _write(self, entry):
+        if self.log:
+            self.log.write(json.dumps(entry, sort_keys=True) + "\n")
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+
+def report(entry):
+    """ Returns a one-line summary of a checkpoint entry """
+    phases = ["sample", "get_batch", "prefetch_sample", "prefetch_get_batch",
+              "batch_wait", "model_step", "save", "background_save"]
+    return ("  phases: %s; tokens/s real %.0f, padded %.0f"
+            % (", ".join(["%s %.2fs" % (p, entry[p]) for p in phases if p in entry]),
+               entry["real_tokens_per_second"], entry["padded_tokens_per_second"]))
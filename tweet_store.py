@@ -0,0 +1,152 @@
+"""Local persistent store of fetched tweets, updated incrementally.
+
+Every account's timeline is kept in a SQLite file keyed by (account, tweet id),
+so re-preparing data only has to ask Twitter for tweets newer than the newest
+stored one (since_id) instead of re-downloading the whole history; the
+fetching itself is done by fetch_scheduler.update_accounts.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import calendar
+import datetime
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+
+# maximum number of tweets user_timeline returns per page
+PAGE_SIZE = 200
+
+
+class TweetColumns(object):
+    """ Compact column store of the tweets of one source: int64 ids, int64
+        epoch timestamps and the utf-8 texts packed into one shared buffer.
+
+        Indexing or iterating gives TweetRef views, so code written for lists
+        of Status objects can read id, created_at and text unchanged; the
+        views are created once and shared by every context that uses them.
+    """
+
+    def __init__(self, ids, epochs, texts):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.epochs = np.asarray(epochs, dtype=np.int64)
+        self.set_texts(texts)
+        self._refs = None
+
+    def set_texts(self, texts):
+        """ Replaces all texts (a list of strings, one per tweet) """
+        encoded = [t.encode("utf-8") for t in texts]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(t) for t in encoded], out=self.offsets[1:])
+        self.buffer = b"".join(encoded)
+
+    def text(self, index):
+        """ Returns the text of tweet index """
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]].decode("utf-8")
+
+    def texts(self):
+        """ Returns the list of all texts """
+        offsets = self.offsets.tolist()
+        buf = self.buffer
+        return [buf[offsets[i]:offsets[i + 1]].decode("utf-8")
+                for i in range(len(self))]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        return self._views()[index]
+
+    def __iter__(self):
+        return iter(self._views())
+
+    def _views(self):
+        if self._refs is None:
+            self._refs = [TweetRef(self, i) for i in range(len(self))]
+        return self._refs
+
+
+class TweetRef(object):
+    """ View of one tweet in a TweetColumns, with the id, created_at (naive
+        UTC datetime) and text attributes of a Status object
+    """
+    __slots__ = ("columns", "index")
+
+    def __init__(self, columns, index):
+        self.columns = columns
+        self.index = index
+
+    @property
+    def id(self):
+        return int(self.columns.ids[self.index])
+
+    @property
+    def created_at(self):
+        return datetime.datetime.utcfromtimestamp(int(self.columns.epochs[self.index]))
+
+    @property
+    def text(self):
+        return self.columns.text(self.index)
+
+
+def _to_epoch(created_at):
+    """ Returns the naive UTC datetime created_at as integer epoch seconds """
+    return calendar.timegm(created_at.utctimetuple())
+
+
+class TweetStore(object):
+    """ SQLite-backed store of tweets for a set of accounts.
+
+        Each method opens its own connection, so one store can be shared by
+        the fetch threads in download_and_prepare.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS tweets ("
+                         " account INTEGER NOT NULL,"
+                         " id INTEGER NOT NULL,"
+                         " created_at INTEGER NOT NULL,"
+                         " text TEXT NOT NULL,"
+                         " PRIMARY KEY (account, id))")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def max_id(self, account):
+        """ Returns the newest stored tweet id of account, or None """
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT MAX(id) FROM tweets WHERE account = ?",
+                               (account,)).fetchone()
+        return row[0]
+
+    def add(self, account, tweets):
+        """ Stores status objects tweets of account, ignoring ones already stored
+
+            Returns:
+                int -- number of newly stored tweets
+        """
+        rows = [(account, t.id, _to_epoch(t.created_at), t.text) for t in tweets]
+        with closing(self._connect()) as conn, conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO tweets VALUES (?, ?, ?, ?)",
+                             rows)
+            return conn.total_changes - before
+
+    def tweets(self, account):
+        """ Returns all stored tweets of account, newest first (the order
+            user_timeline returns them in)
+
+            Returns:
+                TweetColumns -- the tweets of account
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT id, created_at, text FROM tweets"
+                                " WHERE account = ? ORDER BY id DESC",
+                                (account,)).fetchall()
+        return TweetColumns([r[0] for r in rows], [r[1] for r in rows],
+                            [r[2] for r in rows])
+